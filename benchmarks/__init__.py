@@ -0,0 +1,20 @@
+# repocheck - Check the status of code repositories under a root directory.
+# Copyright (C) 2015 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of repocheck.
+#
+# repocheck is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# repocheck is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with repocheck.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks for repocheck, run with 'python -m benchmarks' from the root of
+#  the source tree; see 'python -m benchmarks -h'
@@ -0,0 +1,190 @@
+# repocheck - Check the status of code repositories under a root directory.
+# Copyright (C) 2015 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of repocheck.
+#
+# repocheck is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# repocheck is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with repocheck.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+from contextlib import redirect_stdout
+from subprocess import run, PIPE
+
+from repocheck import RepoCheck, RepoFinder, Viewer
+from .farm import Farm
+
+
+class Benchmark:
+    def __init__(self, treedir, repeat=3, jobs=1):
+        self.treedir = treedir
+        self.repeat = repeat
+        self.jobs = jobs
+
+    def run(self):
+        # Return a {phase: {statistic: seconds}} dictionary; every phase is
+        #  timed separately, so that a change can be attributed to it
+        results = {}
+        for phase, function in (('discovery', self.time_discovery),
+                                ('status', self.time_status),
+                                ('ahead_behind', self.time_ahead_behind),
+                                ('render_short', self.time_render_short),
+                                ('render_expanded',
+                                 self.time_render_expanded),
+                                ('total', self.time_total)):
+            timings = [function() for _ in range(self.repeat)]
+            results[phase] = {'min': min(timings),
+                              'median': statistics.median(timings),
+                              'max': max(timings)}
+        return results
+
+    def _find_repos(self):
+        return [Repo(reldirpath, False) for Repo, reldirpath in
+                RepoFinder((self.treedir, ))]
+
+    def time_discovery(self):
+        start = time.perf_counter()
+        for _ in RepoFinder((self.treedir, )):
+            pass
+        return time.perf_counter() - start
+
+    def time_status(self):
+        # Everything but the ahead/behind counts
+        repos = self._find_repos()
+        start = time.perf_counter()
+        for repo in repos:
+            repo.get_pending_changes()
+            repo.get_current_branch()
+            list(repo.iter_local_branches())
+            list(repo.iter_remote_branches())
+        return time.perf_counter() - start
+
+    def time_ahead_behind(self):
+        repos = self._find_repos()
+        repo_to_pairs = {}
+        for repo in repos:
+            remote_branches = set(repo.iter_remote_branches())
+            repo_to_pairs[repo] = [(branch, remote) for remote, branch in
+                                   remote_branches if branch in
+                                   set(repo.iter_local_branches())]
+        start = time.perf_counter()
+        for repo, pairs in repo_to_pairs.items():
+            repo.count_ahead_behind(pairs)
+        return time.perf_counter() - start
+
+    def _time_render(self, expanded):
+        repos = RepoCheck(rootdirs=(self.treedir, ), jobs=self.jobs,
+                          cache=False).repos
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            Viewer(repos).display_results(expanded=expanded, all_=True)
+        return time.perf_counter() - start
+
+    def time_render_short(self):
+        return self._time_render(False)
+
+    def time_render_expanded(self):
+        return self._time_render(True)
+
+    def time_total(self):
+        start = time.perf_counter()
+        repos = RepoCheck(rootdirs=(self.treedir, ), jobs=self.jobs,
+                          cache=False).repos
+        with redirect_stdout(io.StringIO()):
+            Viewer(repos).display_results()
+        return time.perf_counter() - start
+
+
+def main():
+    cliparser = argparse.ArgumentParser(description="Benchmark repocheck on "
+                                        "a generated tree of repositories.",
+                                        add_help=True)
+    cliparser.add_argument('--farm', metavar='DIR',
+                           help='generate the tree in DIR, or reuse it if it '
+                                'was already generated with the same '
+                                'parameters; by default a temporary directory '
+                                'is used')
+    cliparser.add_argument('--repos', type=int, default=50, metavar='N',
+                           help='number of top-level repositories '
+                                '(default: %(default)s)')
+    cliparser.add_argument('--nested-every', type=int, default=10,
+                           metavar='N',
+                           help='add a nested repository to every Nth '
+                                'repository (default: %(default)s)')
+    cliparser.add_argument('--branches', type=int, default=10, metavar='N',
+                           help='number of branches per repository (default: '
+                                '%(default)s)')
+    cliparser.add_argument('--remotes', type=int, default=2, metavar='N',
+                           help='number of bare remotes per repository '
+                                '(default: %(default)s)')
+    cliparser.add_argument('--dirty-every', type=int, default=5, metavar='N',
+                           help='make about one repository in N dirty '
+                                '(default: %(default)s)')
+    cliparser.add_argument('--dirty-files', type=int, default=1000,
+                           metavar='N',
+                           help='number of untracked files in dirty '
+                                'repositories (default: %(default)s)')
+    cliparser.add_argument('--seed', type=int, default=0,
+                           help='seed for the branch states (default: '
+                                '%(default)s)')
+    cliparser.add_argument('-r', '--repeat', type=int, default=3, metavar='N',
+                           help='time every phase N times (default: '
+                                '%(default)s)')
+    cliparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                           help='jobs for the phases that use RepoCheck '
+                                '(default: %(default)s)')
+    cliparser.add_argument('-o', '--output', metavar='FILE',
+                           help='write the JSON results to FILE instead of '
+                                'the standard output')
+    cliargs = cliparser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='repocheck-farm-') as tempdir:
+        farm = Farm(cliargs.farm or os.path.join(tempdir, 'farm'),
+                    cliargs.repos, cliargs.nested_every, cliargs.branches,
+                    cliargs.remotes, cliargs.dirty_every, cliargs.dirty_files,
+                    cliargs.seed)
+        if not farm.is_generated():
+            print('Generating {}...'.format(farm.rootdir), file=sys.stderr)
+            try:
+                farm.generate()
+            except FileExistsError as error:
+                sys.exit(str(error))
+        results = Benchmark(farm.treedir, cliargs.repeat,
+                            cliargs.jobs).run()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'git': run(('git', '--version'), stdout=PIPE).stdout.decode().strip(),
+        'farm': farm.params,
+        'repeat': cliargs.repeat,
+        'jobs': cliargs.jobs,
+        'results': results,
+    }
+    if cliargs.output:
+        with open(cliargs.output, 'w') as stream:
+            json.dump(report, stream, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
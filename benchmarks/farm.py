@@ -0,0 +1,151 @@
+# repocheck - Check the status of code repositories under a root directory.
+# Copyright (C) 2015 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of repocheck.
+#
+# repocheck is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# repocheck is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with repocheck.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import random
+import shutil
+from subprocess import run, PIPE, DEVNULL
+
+
+class Farm:
+    # Branch states, assigned to the branches of every repository in a
+    #  reproducible pseudo-random order
+    STATES = ('sync', 'ahead', 'behind', 'diverged', 'unpushed')
+
+    def __init__(self, rootdir, repos=50, nested_every=10, branches=10,
+                 remotes=2, dirty_every=5, dirty_files=1000, seed=0):
+        # The tree is generated under rootdir/tree, and the bare repositories
+        #  used as remotes under rootdir/remotes
+        self.rootdir = os.path.abspath(rootdir)
+        self.treedir = os.path.join(self.rootdir, 'tree')
+        self.remotesdir = os.path.join(self.rootdir, 'remotes')
+        self.params = {'repos': repos, 'nested_every': nested_every,
+                       'branches': branches, 'remotes': remotes,
+                       'dirty_every': dirty_every, 'dirty_files': dirty_files,
+                       'seed': seed}
+        self.random = random.Random(seed)
+        # Fixed identities and dates make the commit hashes reproducible
+        self.env = dict(os.environ, GIT_AUTHOR_NAME='repocheck',
+                        GIT_AUTHOR_EMAIL='repocheck@localhost',
+                        GIT_COMMITTER_NAME='repocheck',
+                        GIT_COMMITTER_EMAIL='repocheck@localhost',
+                        GIT_AUTHOR_DATE='2015-01-01T00:00:00Z',
+                        GIT_COMMITTER_DATE='2015-01-01T00:00:00Z',
+                        GIT_CONFIG_NOSYSTEM='1', HOME=self.rootdir)
+
+    def is_generated(self):
+        # Return True if the farm already exists with the same parameters
+        try:
+            with open(os.path.join(self.rootdir, 'farm.json')) as stream:
+                return json.load(stream) == self.params
+        except (OSError, ValueError):
+            return False
+
+    def generate(self):
+        # A farm generated with other parameters is replaced, but nothing
+        #  that was not generated as a farm is ever deleted
+        if os.path.exists(self.treedir) or os.path.exists(self.remotesdir):
+            if not os.path.exists(os.path.join(self.rootdir, 'farm.json')):
+                raise FileExistsError('{} already contains a tree or remotes '
+                                      'directory that is not a complete '
+                                      'farm; remove it or choose another '
+                                      'directory'.format(self.rootdir))
+            shutil.rmtree(self.treedir, ignore_errors=True)
+            shutil.rmtree(self.remotesdir, ignore_errors=True)
+        os.makedirs(self.treedir)
+        os.makedirs(self.remotesdir)
+        for index in range(self.params['repos']):
+            repodir = os.path.join(self.treedir, 'group{}'.format(index % 7),
+                                   'repo{}'.format(index))
+            self._make_repo(repodir, 'repo{}'.format(index))
+            if self.params['nested_every'] and \
+                    index % self.params['nested_every'] == 0:
+                self._make_repo(os.path.join(repodir, 'vendor', 'lib'),
+                                'repo{}-lib'.format(index))
+        with open(os.path.join(self.rootdir, 'farm.json'), 'w') as stream:
+            json.dump(self.params, stream)
+
+    def _make_repo(self, repodir, name):
+        os.makedirs(repodir)
+        self._git(repodir, 'init', '-q', '-b', 'master')
+        for filename in ('README', 'main.c'):
+            with open(os.path.join(repodir, filename), 'w') as stream:
+                stream.write('{} {}\n'.format(name, filename))
+        self._git(repodir, 'add', '.')
+        self._git(repodir, 'commit', '-q', '-m', 'Initial commit')
+        base = self._git(repodir, 'rev-parse', 'HEAD')
+        tree = self._git(repodir, 'rev-parse', 'HEAD^{tree}')
+
+        # Every branch starts with its own commit, so that the branches do
+        #  not trivially point to the same commit
+        branches = ['branch{}'.format(index)
+                    for index in range(self.params['branches'])]
+        tips = {}
+        for branch in branches:
+            tips[branch] = self._commit(repodir, tree, base, branch)
+            self._git(repodir, 'update-ref', 'refs/heads/' + branch,
+                      tips[branch])
+
+        for index in range(self.params['remotes']):
+            remote = 'remote{}'.format(index)
+            remotedir = os.path.join(self.remotesdir, '{}-{}.git'.format(
+                                                                name, remote))
+            self._git(self.remotesdir, 'init', '-q', '--bare', remotedir)
+            self._git(repodir, 'remote', 'add', remote, remotedir)
+            self._git(repodir, 'push', '-q', remote, '--all')
+        # Half of the branches track their first remote, the others have no
+        #  upstream, so that both ways of computing their status are used
+        if self.params['remotes']:
+            for branch in branches[::2]:
+                self._git(repodir, 'push', '-q', '-u', 'remote0', branch)
+
+        for branch in branches:
+            state = self.random.choice(self.STATES)
+            if state == 'ahead':
+                tip = self._commit(repodir, tree, tips[branch], 'ahead')
+            elif state == 'behind':
+                tip = base
+            elif state == 'diverged':
+                tip = self._commit(repodir, tree, base, 'diverged')
+            elif state == 'unpushed':
+                tip = self._commit(repodir, tree, base, 'unpushed')
+                branch += '-unpushed'
+            else:
+                continue
+            self._git(repodir, 'update-ref', 'refs/heads/' + branch, tip)
+
+        if self.params['dirty_every'] and \
+                self.random.randrange(self.params['dirty_every']) == 0:
+            with open(os.path.join(repodir, 'main.c'), 'a') as stream:
+                stream.write('/* modified */\n')
+            # Untracked files in a subdirectory would be reported as one
+            #  entry by 'git status'
+            for index in range(self.params['dirty_files']):
+                with open(os.path.join(repodir, 'object{}.o'.format(index)),
+                          'w') as stream:
+                    stream.write('{}\n'.format(index))
+
+    def _commit(self, repodir, tree, parent, message):
+        return self._git(repodir, 'commit-tree', tree, '-p', parent, '-m',
+                         message)
+
+    def _git(self, cwd, *args):
+        process = run(('git', ) + args, cwd=cwd, env=self.env, stdout=PIPE,
+                      stderr=DEVNULL, check=True)
+        return process.stdout.decode().strip()
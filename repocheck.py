@@ -21,164 +21,1978 @@
 import sys
 import argparse
 import os
-from subprocess import Popen, PIPE
+import re
+import json
+import time
+import shutil
+import struct
+import signal
+import asyncio
+import threading
+from fnmatch import fnmatch
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from urllib.parse import urlsplit, unquote
+from xml.etree import ElementTree
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def _parse_duration(text):
+    # Return the seconds of a duration like '90', '30s', '10m', '2h' or '1d';
+    #  this is an argparse type
+    match = re.match(r'(\d+(?:\.\d+)?)([smhdw]?)$', text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid duration: {}'.format(text))
+    return float(match.group(1)) * _DURATION_UNITS.get(match.group(2), 1)
+
+
+def _format_duration(seconds):
+    # Use the largest unit that represents seconds exactly
+    for unit, size in sorted(_DURATION_UNITS.items(), key=lambda item:
+                             item[1], reverse=True):
+        if seconds >= size and seconds % size == 0:
+            return '{}{}'.format(int(seconds // size), unit)
+    return '{:g}s'.format(seconds)
+
+
+def _get_cache_path(filename):
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+                                            os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'repocheck', filename)
 
 
 class RepoCheck:
     def __init__(self, update_remotes=False, rootdirs=('./', ),
-                 followlinks=False, nested_repos=True, rel_paths=False):
+                 followlinks=False, nested_repos=True, rel_paths=False,
+                 jobs=1, fetch_jobs=8, fetch_host_jobs=2, cache=True,
+                 exclude=(), max_depth=None, rescan=False, stream=False,
+                 untracked=True, untracked_cache=False, fsmonitor=False,
+                 timeout=None, command_timeout=None,
+                 fetch_if_older_than=None, counts_only=False, exec_hooks=(),
+                 lazy=False):
         # __init__'s arguments must match the argparse attributes and their
-        #  default values
+        #  default values, except for the following ones, which are only
+        #  available to library users:
+        #  - counts_only: only count the uncommitted and untracked files;
+        #    the repositories' uncommitted and untracked lists are then None
+        #  - exec_hooks: every callable in it is called with an ExecRecord
+        #    after each command executed for a repository
+        #  - lazy: do not inspect the repositories in the worker pool; their
+        #    fields are computed on first access instead, and are not stored
+        #    in the status cache
         # Having a separate class allows using it as a library from another
         #  script
-        self.INSTALLED_VCS = (_Git, )
+        # With stream=True self.repos is left empty and the repositories
+        #  must be retrieved with iter_repos, so that they can be released
+        #  one at a time
+        self.update_remotes = update_remotes
+        self.rel_paths = rel_paths
+        self.jobs = max(jobs, 1)
+        self.fetch_jobs = fetch_jobs
+        self.fetch_host_jobs = fetch_host_jobs
+        self.cache = cache
+        self.exec_hooks = exec_hooks
+        self.lazy = lazy
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.fetch_if_older_than = fetch_if_older_than
+        self.status_options = {'counts_only': counts_only,
+                               'untracked': untracked,
+                               'untracked_cache': untracked_cache,
+                               'fsmonitor': fsmonitor}
+        self.timings = {'discovery': 0.0, 'fetch': 0.0, 'inspection': 0.0}
+        self.finder = RepoFinder(rootdirs, followlinks, nested_repos, exclude,
+                                 max_depth, None, rescan)
+        self.INSTALLED_VCS = self.finder.INSTALLED_VCS
         self.repos = {}
+        self.fetch_results = {}
+        if not stream:
+            for repo in self.iter_repos():
+                self.repos[repo.absdirpath] = repo
+
+    def iter_repos(self):
+        # Yield the inspected repositories in discovery order, as soon as
+        #  they are ready
+        if self.cache:
+            self.finder.index = _Cache('index.json', 100)
+        status_cache = _Cache('status.json', 5000) if self.cache else None
+        context = _InspectContext(status_cache, self.exec_hooks,
+                                  self.status_options, self.update_remotes,
+                                  self.timeout, self.command_timeout)
+        repos = self._iter_found_repos(context)
+
+        # Fetching is a separate stage, so that the network waits of all the
+        #  repositories overlap, but it must be completed before the status
+        #  of the repositories is collected
+        if self.update_remotes:
+            repos = list(repos)
+            start = time.perf_counter()
+            fetch_state = _Cache('fetch-state.json', 5000) if self.cache \
+                else None
+            self.fetch_results = _RemoteUpdater(
+                        self.fetch_jobs, self.fetch_host_jobs,
+                        self.fetch_if_older_than, fetch_state).run(repos)
+            if fetch_state is not None:
+                fetch_state.save()
+            self.timings['fetch'] = time.perf_counter() - start
+
+        # Discovery is interleaved with the inspection, and the consumer may
+        #  do its own work between two repositories, so only the time spent
+        #  in this generator, minus the time spent in discovery, is
+        #  accounted to the inspection
+        discovery = self.timings['discovery']
+        start = time.perf_counter()
+        for repo in repos if self.lazy else self._inspect_repos(repos):
+            self.timings['inspection'] += time.perf_counter() - start - (
+                                        self.timings['discovery'] - discovery)
+            discovery = self.timings['discovery']
+            yield repo
+            start = time.perf_counter()
+
+        if status_cache is not None:
+            status_cache.save()
+        self.timings['inspection'] += time.perf_counter() - start - (
+                                        self.timings['discovery'] - discovery)
+
+    def _inspect_repos(self, repos):
+        # The repositories are inspected concurrently, but they are yielded
+        #  in discovery order; only a bounded number of them is submitted
+        #  ahead of the one that is waited for, so that this reorder buffer
+        #  never grows with the size of the tree
+        # The repositories of the backends that support it are grouped in
+        #  batches, each inspected by a single job; a batch is submitted
+        #  when it is full, or early when one of its repositories is the
+        #  next to be yielded
+        window = max([self.jobs * 4] + [Repo.BATCH_SIZE * 2 for Repo in
+                                        self.INSTALLED_VCS if Repo.BATCH_SIZE])
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = deque()
+            batches = {}
+
+            def submit_batch(Repo):
+                try:
+                    batch = batches.pop(Repo)
+                except KeyError:
+                    return
+                future = executor.submit(Repo.inspect_batch,
+                                         [item[1] for item in batch])
+                for item in batch:
+                    item[0] = future
+
+            def wait(item):
+                if item[0] is None:
+                    submit_batch(type(item[1]))
+                item[0].result()
+                return item[1]
+
+            for repo in repos:
+                # Each item is a [future, repo] list
+                item = [None, repo]
+                pending.append(item)
+                if repo.BATCH_SIZE is None:
+                    item[0] = executor.submit(repo.inspect)
+                else:
+                    batch = batches.setdefault(type(repo), [])
+                    batch.append(item)
+                    if len(batch) >= repo.BATCH_SIZE:
+                        submit_batch(type(repo))
+                if len(pending) >= window:
+                    yield wait(pending.popleft())
+            while pending:
+                yield wait(pending.popleft())
+
+    def _iter_found_repos(self, context):
+        seen = set()
+        finder = iter(self.finder)
+        while True:
+            start = time.perf_counter()
+            try:
+                Repo, reldirpath = next(finder)
+            except StopIteration:
+                break
+            finally:
+                self.timings['discovery'] += time.perf_counter() - start
+            repo = Repo(reldirpath, self.rel_paths, context)
+            # Overlapping root directories may find a repository twice
+            if repo.absdirpath not in seen:
+                seen.add(repo.absdirpath)
+                yield repo
+        if self.finder.index is not None:
+            self.finder.index.save()
+
+
+class RepoFinder:
+    # Never look for repositories inside the metadata directories of any
+    #  version control system, whether it is installed or not
+    VCS_DIRS = {'.git', '.hg', '.svn', '.bzr', '_darcs', 'CVS'}
+    # Nanoseconds; a directory may still change within the same mtime,
+    #  e.g. on FAT, whose timestamps have a 2-second granularity
+    RACY_MTIME_WINDOW = 2 * 10 ** 9
+
+    def __init__(self, rootdirs=('./', ), followlinks=False,
+                 nested_repos=True, exclude=(), max_depth=None, index=None,
+                 rescan=False):
+        # Iterating over an instance lazily yields (Repo, reldirpath) tuples
+        #  for the repositories found under rootdirs
+        # If an index is given, the directories whose mtime has not changed
+        #  since the last run are not listed again; rescan only updates the
+        #  index without reading it
+        self.INSTALLED_VCS = tuple(Repo for Repo in (_Git, _Mercurial,
+                                                     _Subversion)
+                                   if shutil.which(Repo.COMMAND))
+        self.rootdirs = rootdirs
+        self.followlinks = followlinks
+        self.nested_repos = nested_repos
+        self.exclude = exclude
+        self.max_depth = max_depth
+        self.index = index
+        self.rescan = rescan
+
+    def __iter__(self):
         # TODO: It should also work if executed from within a folder inside a
         #       repository (bug #6)
-        for rootdir in rootdirs:
-            for reldirpath, dirnames, filenames in os.walk(
-                    rootdir, followlinks=followlinks):
-                for Repo in self.INSTALLED_VCS:
-                    if Repo.DOTDIR in dirnames:
-                        repo = Repo(reldirpath, update_remotes, rel_paths)
-                        self.repos[repo.absdirpath] = repo
-                        break
-                else:
+        for rootdir in self.rootdirs:
+            yield from self._walk(rootdir)
+
+    def _walk(self, rootdir):
+        dotdir_to_vcs = {Repo.DOTDIR: Repo for Repo in self.INSTALLED_VCS}
+        # The index is only valid for the same search options
+        indexkey = os.path.abspath(rootdir)
+        fingerprint = [self.followlinks, sorted(self.exclude),
+                       sorted(dotdir_to_vcs)]
+        dirs = None
+        if self.index is not None and not self.rescan:
+            dirs = self.index.get(indexkey, fingerprint)
+        dirs = dirs or {}
+        newdirs = {}
+        # Like git's racily clean index entries, listings whose mtime is too
+        #  close to the scan could miss a change with the same mtime, and
+        #  are stored without it, so that they are listed again next time
+        racytime = time.time_ns() - self.RACY_MTIME_WINDOW
+        # Directories are identified by (st_dev, st_ino), so that following
+        #  links can never visit the same directory twice, which would
+        #  otherwise lead to infinite recursion with links to ancestors
+        visited = set()
+        # Use an explicit stack rather than recursion, since trees can be
+        #  arbitrarily deep
+        stack = [(rootdir, 0)]
+        while stack:
+            reldirpath, depth = stack.pop()
+            relpath = os.path.relpath(reldirpath, rootdir)
+            mtime = None
+            if self.followlinks or self.index is not None:
+                try:
+                    stat = os.stat(reldirpath)
+                except OSError:
+                    continue
+                if self.followlinks:
+                    key = (stat.st_dev, stat.st_ino)
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                mtime = stat.st_mtime_ns
+            try:
+                cachedmtime, dotdir, subdirs = dirs[relpath]
+            except KeyError:
+                cachedmtime = None
+            # A directory's mtime changes when entries are added to, removed
+            #  from or renamed in it, so its listing is still valid if the
+            #  mtime has not changed; its subdirectories are still visited
+            #  to check their own mtimes
+            if mtime is None or mtime != cachedmtime:
+                try:
+                    dotdir, subdirs = self._scan(reldirpath, rootdir,
+                                                 dotdir_to_vcs)
+                except OSError:
+                    continue
+            if self.index is not None:
+                newdirs[relpath] = [None if mtime >= racytime else mtime,
+                                    dotdir, subdirs]
+
+            if dotdir is not None:
+                yield (dotdir_to_vcs[dotdir], reldirpath)
+                if not self.nested_repos:
+                    continue
+
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+
+            # Reverse the subdirectories so that they are popped in sorted
+            #  order
+            stack.extend((os.path.join(reldirpath, name), depth + 1)
+                         for name in reversed(subdirs))
+
+        if self.index is not None:
+            # Only directories that were actually visited are stored, so
+            #  with a partial walk (e.g. --max-depth) only that part is
+            #  indexed
+            self.index.set(indexkey, fingerprint, newdirs)
+
+    def _scan(self, reldirpath, rootdir, dotdir_to_vcs):
+        # Return the VCS metadata directory of reldirpath, if any, and the
+        #  sorted names of the subdirectories that should be visited
+        subdirs = []
+        dotdirs = set()
+        with os.scandir(reldirpath) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if entry.name in self.VCS_DIRS:
+                    # Linked worktrees and submodules have a '.git' file
+                    #  pointing to the actual git directory
+                    if is_dir or (entry.name == '.git' and
+                                  self._is_gitdir_file(entry.path)):
+                        dotdirs.add(entry.name)
+                elif not is_dir:
                     continue
-                if not nested_repos:
-                    dirnames.clear()
+                elif not self._is_excluded(entry.name, os.path.relpath(
+                        entry.path, rootdir)) and (self.followlinks or
+                                                   not entry.is_symlink()):
+                    subdirs.append(entry.name)
+        for Repo in self.INSTALLED_VCS:
+            if Repo.DOTDIR in dotdirs:
+                return (Repo.DOTDIR, sorted(subdirs))
+        return (None, sorted(subdirs))
+
+    @staticmethod
+    def _is_gitdir_file(path):
+        try:
+            with open(path, 'rb') as stream:
+                return stream.read(8) == b'gitdir: '
+        except OSError:
+            return False
+
+    def _is_excluded(self, name, relpath):
+        relpath = relpath.replace(os.sep, '/')
+        for pattern in self.exclude:
+            if fnmatch(name, pattern) or fnmatch(relpath, pattern):
+                return True
+        return False
+
+
+class _RemoteUpdater:
+    # The longest delay before a failing remote is tried again
+    MAX_BACKOFF = 86400
+
+    def __init__(self, jobs, host_jobs, max_age=None, state=None):
+        # With max_age, in seconds, only the remotes that were last fetched
+        #  longer ago are fetched, and the remotes that keep failing are
+        #  tried again less and less often; state is a _Cache that stores
+        #  the last fetch of every remote across runs
+        self.jobs = max(jobs, 1)
+        self.host_jobs = max(host_jobs, 1)
+        self.max_age = max_age
+        self.state = state
+
+    def run(self, repos):
+        # Return a {absdirpath: {remote: (returncode, message)}} dictionary;
+        #  the remotes that are skipped are left out
+        self.fresh = 0
+        self.backoff = []
+        results = asyncio.run(self._run(repos))
+        if self.fresh:
+            print('Skipped {} remotes fetched less than {} ago'.format(
+                  self.fresh, _format_duration(self.max_age)), file=sys.stderr)
+        if self.backoff:
+            print('Skipped {} failing remotes until their next retry: '
+                  '{}'.format(len(self.backoff), ', '.join(self.backoff)),
+                  file=sys.stderr)
+        return results
+
+    async def _run(self, repos):
+        self.global_slots = asyncio.Semaphore(self.jobs)
+        self.host_slots = {}
+        # Repositories that share their remotes, e.g. git worktrees, are
+        #  fetched only once, through the first one
+        key_to_group = {}
+        for repo in repos:
+            key_to_group.setdefault(repo.get_shared_key() or repo.absdirpath,
+                                    []).append(repo)
+        # Repositories that borrow objects from others through alternates
+        #  are fetched after them, so that the objects that were already
+        #  fetched there are not downloaded again
+        store_to_key = {}
+        for key, group in key_to_group.items():
+            store = group[0].get_object_store()
+            if store is not None:
+                store_to_key[store] = key
+        # Only the stores of the other repositories that are fetched count
+        dependencies = {key: [store_to_key[store]
+                              for store in group[0].get_alternates()
+                              if store_to_key.get(store, key) != key]
+                        for key, group in key_to_group.items()}
+        self.break_cycles(dependencies)
+        # The repositories' own records of their last fetches are read
+        #  before any fetch of this run can rewrite them
+        if self.max_age is not None:
+            self.last_fetch_times = {key: group[0].get_last_fetch_times()
+                                     for key, group in key_to_group.items()}
+        self.fetched = {key: asyncio.Event() for key in key_to_group}
+        results = await asyncio.gather(*(
+                        self._update_group(key, group, dependencies[key])
+                        for key, group in key_to_group.items()))
+        return {repo.absdirpath: group_results
+                for group, group_results in zip(key_to_group.values(),
+                                                results)
+                for repo in group}
+
+    @staticmethod
+    def break_cycles(dependencies):
+        # Drop, in place, the dependencies that would close a cycle, which
+        #  would otherwise wait forever
+        def depends(key, dependency, visited):
+            if key == dependency:
+                return True
+            visited.add(key)
+            return any(depends(nextkey, dependency, visited)
+                       for nextkey in dependencies[key]
+                       if nextkey not in visited)
+
+        for key, keys in dependencies.items():
+            dependencies[key] = [dependency for dependency in keys
+                                 if not depends(dependency, key, set())]
+
+    async def _update_group(self, key, group, dependencies):
+        for dependency in dependencies:
+            await self.fetched[dependency].wait()
+        try:
+            return await self._update(group[0])
+        finally:
+            self.fetched[key].set()
+
+    async def _update(self, repo):
+        try:
+            results = await repo.do_update_remotes(self)
+        except CommandTimeout:
+            print('Could not update {} remotes: timed out'.format(
+                  repo.displayname), file=sys.stderr)
+            return {}
+        finally:
+            # The inspection has a deadline of its own
+            repo.refresh()
+        # None means that the backend has nothing to fetch, and an empty
+        #  dictionary that all the remotes were skipped
+        if not results:
+            return {}
+        failed = [remote for remote in sorted(results)
+                  if results[remote][0] != 0]
+        if failed:
+            print('Could not update {} remotes: {}'.format(repo.displayname,
+                  ', '.join(failed)), file=sys.stderr)
+        else:
+            print('Updated {} remotes'.format(repo.displayname),
+                  file=sys.stderr)
+        return results
+
+    async def exec(self, repo, *args):
+        # Run a local command of repo, e.g. to list its remotes, and return
+        #  its output; it takes a global slot too, so that the number of
+        #  processes, and of their open pipes, stays bounded
+        async with self.global_slots:
+            return await repo._aexec(*args)
+
+    async def fetch(self, repo, remote, url, *args):
+        # Run the fetch command args for remote, and return (returncode,
+        #  message), or None if the remote is skipped
+        repokey = repo.get_shared_key() or repo.absdirpath
+        key = '{}:{}'.format(repokey, remote)
+        # The state is only valid for the same URL
+        entry = None if self.state is None else self.state.get(key, url)
+        now = time.time()
+        if self.max_age is not None:
+            if entry is not None and entry['failures']:
+                # The delay doubles with every consecutive failure
+                if now - entry['attempted'] < min(
+                        self.max_age * 2 ** (entry['failures'] - 1),
+                        self.MAX_BACKOFF):
+                    self.backoff.append('{} ({})'.format(repo.displayname,
+                                                         remote))
+                    return None
+            else:
+                # Without a state, e.g. on the first run, use the
+                #  repository's own record of the last fetch of the remote,
+                #  as it was before the fetches of this run
+                if entry is None:
+                    fetched = self.last_fetch_times[repokey].get(
+                        repo.normalize_fetch_url(url))
+                else:
+                    fetched = entry['fetched']
+                if fetched is not None and now - fetched < self.max_age:
+                    # Later fetches of other remotes rewrite the
+                    #  repository's record, so it is kept in the state
+                    if entry is None and self.state is not None:
+                        self.state.set(key, url, {'fetched': fetched,
+                                                  'failures': 0})
+                    self.fresh += 1
+                    return None
+        result = await self._fetch(repo, url, *args)
+        if self.state is not None:
+            if result[0] == 0:
+                fields = {'fetched': time.time(), 'failures': 0}
+            else:
+                fields = {'fetched': None if entry is None else
+                          entry['fetched'],
+                          'failures': 1 if entry is None else
+                          entry['failures'] + 1,
+                          'attempted': time.time()}
+            self.state.set(key, url, fields)
+        return result
+
+    async def _fetch(self, repo, url, *args):
+        # Limit both the total number of fetches and the number of fetches
+        #  from the same host; the host slot is acquired first, so that no
+        #  global slot is held while waiting for a busy host
+        host = self.get_url_host(url)
+        try:
+            host_slots = self.host_slots[host]
+        except KeyError:
+            host_slots = self.host_slots[host] = asyncio.Semaphore(
+                                                            self.host_jobs)
+        async with host_slots, self.global_slots:
+            # Every fetch has a deadline of its own, started only now, so
+            #  that the time spent waiting for the slots is not counted; a
+            #  fetch that times out only fails its own remote
+            timeout = repo.context.command_timeout
+            if repo.context.timeout is not None and (
+                    timeout is None or repo.context.timeout < timeout):
+                timeout = repo.context.timeout
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                repo.COMMAND, *args, cwd=repo.absdirpath, stdin=DEVNULL,
+                stdout=DEVNULL, stderr=PIPE,
+                start_new_session=timeout is not None)
+            try:
+                stderr = await repo._acommunicate(process, timeout)
+            except CommandTimeout as error:
+                repo._report_exec(args, start, process.returncode, 0)
+                return (process.returncode, str(error))
+            repo._report_exec(args, start, process.returncode,
+                              len(stderr[1]))
+        # Report the actual error rather than git's trailing hints
+        lines = stderr[1].decode(errors='replace').strip().splitlines()
+        for line in lines:
+            if line.startswith(('fatal: ', 'error: ')):
+                return (process.returncode, line)
+        return (process.returncode, lines[-1] if lines else '')
+
+    @staticmethod
+    def get_url_host(url):
+        # Local paths and file:// URLs all share the '' host
+        if '://' in url:
+            return urlsplit(url).hostname or ''
+        # scp-like syntax, e.g. 'user@host:path'
+        match = re.match(r'(?:[^@/]+@)?([^:/]+):', url)
+        return match.group(1) if match else ''
+
+
+class _Cache:
+    VERSION = 3
+
+    def __init__(self, filename, max_entries):
+        self.path = _get_cache_path(filename)
+        # Least recently used entries beyond this limit are dropped when
+        #  saving
+        self.max_entries = max_entries
+        try:
+            with open(self.path) as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            data = None
+        if isinstance(data, dict) and data.get('version') == self.VERSION:
+            self.entries = data['entries']
+        else:
+            self.entries = {}
+
+    def get(self, key, fingerprint):
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            return None
+        if entry['fingerprint'] != fingerprint:
+            return None
+        entry['used'] = time.time()
+        return entry['fields']
+
+    def set(self, key, fingerprint, fields):
+        self.entries[key] = {'fingerprint': fingerprint, 'fields': fields,
+                             'used': time.time()}
+
+    def save(self):
+        keys = sorted(self.entries, key=lambda key: self.entries[key]['used'],
+                      reverse=True)
+        entries = {key: self.entries[key] for key in keys[:self.max_entries]}
+        # Write to a temporary file first, so that concurrent runs never see
+        #  a truncated cache
+        temppath = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temppath, 'w') as stream:
+                json.dump({'version': self.VERSION, 'entries': entries},
+                          stream)
+            os.replace(temppath, self.path)
+        except OSError:
+            pass
+
+
+# The data passed to RepoCheck's exec_hooks for every executed command;
+#  time is the wall time in seconds and output_size the size of its standard
+#  output in bytes (of its standard error for fetches); returncode is None
+#  for a Mercurial command server that failed; forked is False for the
+#  commands run by a command server, which start no process of their own
+ExecRecord = namedtuple('ExecRecord', ('command', 'repo', 'time',
+                                       'returncode', 'output_size',
+                                       'forked'))
+
+
+class CommandTimeout(Exception):
+    # Raised when a command of a repository is killed because it exceeded
+    #  its timeout or the deadline of the repository
+    pass
+
+
+def _kill_process_group(pid):
+    # The process must have been started with start_new_session=True, so
+    #  that its children, e.g. ssh, are killed too
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class _Watchdog:
+    def __init__(self, process, timeout):
+        # Kill the process group of process if it is still running after
+        #  timeout seconds; a timeout of None disables the watchdog
+        self.process = process
+        self.expired = False
+        self.timer = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        self.expired = True
+        _kill_process_group(self.process.pid)
+
+    def cancel(self):
+        # After this the process is never killed by the timer, so it can
+        #  be safely reaped: its pid cannot be reused in the meantime
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer.join()
+
+    def wait(self):
+        # Reap the process, which has already closed its output, and return
+        #  its exit status
+        self.cancel()
+        if self.timer is None:
+            return self.process.wait()
+        try:
+            return self.process.wait(max(self.deadline - time.monotonic(),
+                                         0))
+        except TimeoutExpired:
+            self.kill()
+            return self.process.wait()
+
+
+class _SharedResults:
+    def __init__(self):
+        # Compute every result only once for all the repositories with the
+        #  same key, also when they are inspected concurrently
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, function):
+        with self.lock:
+            try:
+                entry = self.entries[key]
+            except KeyError:
+                entry = self.entries[key] = [threading.Lock(), None]
+        # If function raises, the next repository tries again
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = function()
+            return entry[1]
+
+
+class _InspectContext:
+    # The settings shared by all the repositories of a run
+    __slots__ = ('cache', 'exec_hooks', 'status_options', 'update_remotes',
+                 'timeout', 'command_timeout', 'shared')
+
+    def __init__(self, cache=None, exec_hooks=(), status_options=None,
+                 update_remotes=False, timeout=None, command_timeout=None):
+        # status_options are passed to get_pending_changes; update_remotes
+        #  lets the backends without a fetch stage, i.e. Subversion, query
+        #  their server during the inspection
+        # timeout is the deadline in seconds of every repository, counted
+        #  from its first command, and command_timeout the one of every
+        #  single command; None means no limit
+        self.cache = cache
+        self.exec_hooks = exec_hooks
+        self.status_options = status_options or {}
+        self.update_remotes = update_remotes
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.shared = _SharedResults()
 
 
 class _Repository:
     COMMAND = None
     DOTDIR = None
+    # Backends that can inspect many repositories with the same commands
+    #  set the maximum number of repositories per call, and implement the
+    #  inspect_batch class method
+    BATCH_SIZE = None
+    # The expensive fields are computed in two groups, each only on first
+    #  access, and stored as tuples to keep the instances compact
+    __slots__ = ('context', 'absdirpath', 'displayname', 'inspect_time',
+                 'timed_out', '_deadline', '_workspace', '_branches')
+    # The fields of a group that could not be computed because a command
+    #  timed out are all None
+    UNKNOWN_WORKSPACE = (None, None, None, None, None)
+    UNKNOWN_BRANCHES = (None, None, None)
 
-    def __init__(self, reldirpath, update_remotes, rel_paths):
+    def __init__(self, reldirpath, rel_paths, context=None):
+        self.context = context or _InspectContext()
         self.absdirpath = os.path.abspath(reldirpath)
         # Use the absolute path so that the correct repo name
         #  is displayed even if called from the root folder
         #  of a repository
         self.displayname = reldirpath if rel_paths else os.path.basename(
                                                             self.absdirpath)
+        self.refresh()
+
+    def refresh(self):
+        # Forget the computed fields, so that they are computed again on
+        #  next access, e.g. in long-running processes; this also starts a
+        #  new deadline
+        self.inspect_time = 0.0
+        self.timed_out = False
+        self._deadline = None
+        self._workspace = None
+        self._branches = None
+
+    def inspect(self):
+        # Compute all the fields now
+        self._get_workspace()
+        self._get_branches()
+
+    @property
+    def uncommitted(self):
+        return self._get_workspace()[0]
+
+    @property
+    def untracked(self):
+        return self._get_workspace()[1]
+
+    @property
+    def uncommitted_count(self):
+        return self._get_workspace()[2]
 
-        if update_remotes:
-            print('Updating {} remotes...'.format(self.displayname))
-            self.do_update_remotes()
+    @property
+    def untracked_count(self):
+        return self._get_workspace()[3]
 
-        self.uncommitted, self.untracked = self.get_pending_changes()
-        self.current_branch = self.get_current_branch()
-        self.remote_to_branches = {}
-        self.branch_to_remotes_to_status = {}
-        self.branch_stats = {'=': 0, '>': 0, '<': 0, '#': 0, '}': 0, '{': 0}
+    @property
+    def current_branch(self):
+        return self._get_workspace()[4]
+
+    @property
+    def remote_to_branches(self):
+        return self._get_branches()[0]
+
+    @property
+    def branch_to_remotes_to_status(self):
+        return self._get_branches()[1]
+
+    @property
+    def branch_stats(self):
+        return self._get_branches()[2]
+
+    def _get_workspace(self):
+        if self._workspace is None:
+            start = time.perf_counter()
+            try:
+                workspace = self.get_pending_changes(
+                                            **self.context.status_options)
+                if workspace[4] is None:
+                    workspace = workspace[:4] + (self.get_current_branch(), )
+            except CommandTimeout:
+                workspace = self.UNKNOWN_WORKSPACE
+            self._workspace = workspace
+            self.inspect_time += time.perf_counter() - start
+        return self._workspace
+
+    def _get_branches(self):
+        # Only the fields that derive from the refs are cached: editing a
+        #  tracked file does not leave any trace in the repository metadata,
+        #  so the workspace status must always be collected
+        # Repositories that share their refs, e.g. git worktrees, also share
+        #  these fields, which are then computed only once per run, and
+        #  cached under the shared key
+        if self._branches is None:
+            start = time.perf_counter()
+            key = self.get_shared_key()
+            try:
+                if key is None:
+                    self._branches = self._inspect_branches(self.absdirpath)
+                else:
+                    self._branches = self.context.shared.get(
+                                key, lambda: self._inspect_branches(key))
+            except CommandTimeout:
+                self._branches = self.UNKNOWN_BRANCHES
+            self.inspect_time += time.perf_counter() - start
+        return self._branches
+
+    def _inspect_branches(self, cachekey):
+        cache = self.context.cache
+        if cache is None:
+            return self.inspect_branches()
+        return self._inspect_cached_branches(cache, cachekey)
+
+    def _inspect_cached_branches(self, cache, cachekey):
+        fingerprint = self.get_fingerprint()
+        # Some VCSs cannot tell cheaply whether the fields are still valid
+        if fingerprint is None:
+            return self.inspect_branches()
+        fields = cache.get(cachekey, fingerprint)
+        if fields is None:
+            branches = self.inspect_branches()
+            cache.set(cachekey, fingerprint, {
+                'remote_to_branches': branches[0],
+                'branch_to_remotes_to_status': branches[1],
+                'branch_stats': branches[2]})
+            return branches
+        # JSON turns the status tuples into lists
+        return (fields['remote_to_branches'],
+                {branch: {remote: None if status is None else tuple(status)
+                          for remote, status in remotes_to_status.items()}
+                 for branch, remotes_to_status in
+                 fields['branch_to_remotes_to_status'].items()},
+                fields['branch_stats'])
+
+    def get_shared_key(self):
+        # Return a key that is the same for the repositories that share their
+        #  refs and remotes, or None if the repository shares nothing
+        return None
+
+    def get_last_fetch_times(self):
+        # Return {url: time} for the last fetch of the remotes that the VCS
+        #  records, for the remotes that have no fetch state yet; the URLs
+        #  are normalized by normalize_fetch_url
+        return {}
+
+    @staticmethod
+    def normalize_fetch_url(url):
+        return url
+
+    def get_object_store(self):
+        # Return the real path of the object store, for the VCSs that
+        #  support borrowing objects from other repositories
+        return None
+
+    def get_alternates(self):
+        # Return the real paths of the object stores of other repositories
+        #  that objects are borrowed from
+        return ()
+
+    def inspect_branches(self):
+        # Return (remote_to_branches, branch_to_remotes_to_status,
+        #  branch_stats)
+        remote_to_branches = {}
+        branch_to_remotes_to_status = {}
 
         for remote, branch in self.iter_remote_branches():
             try:
-                self.remote_to_branches[remote].append(branch)
+                remote_to_branches[remote].append(branch)
             except KeyError:
-                self.remote_to_branches[remote] = [branch, ]
+                remote_to_branches[remote] = [branch, ]
             try:
-                self.branch_to_remotes_to_status[branch]
+                branch_to_remotes_to_status[branch]
             except KeyError:
-                self.branch_to_remotes_to_status[branch] = {remote: None}
+                branch_to_remotes_to_status[branch] = {remote: None}
             else:
-                self.branch_to_remotes_to_status[branch][remote] = None
+                branch_to_remotes_to_status[branch][remote] = None
 
+        pairs = []
         for branch in self.iter_local_branches():
             try:
-                remotes_to_status = self.branch_to_remotes_to_status[branch]
+                remotes_to_status = branch_to_remotes_to_status[branch]
             except KeyError:
                 # The branch hasn't been pushed to any remote
-                self.branch_to_remotes_to_status[branch] = {}
-                self.branch_stats['}'] += 1
+                branch_to_remotes_to_status[branch] = {}
             else:
-                for remote in remotes_to_status:
-                    remote_branch = '/'.join((remote, branch))
-                    localahead = self.count_commits_ahead(branch,
-                                                          remote_branch)
-                    remoteahead = self.count_commits_ahead(remote_branch,
-                                                           branch)
-                    remotes_to_status[remote] = (localahead, remoteahead)
-                    if localahead > 0:
-                        if remoteahead > 0:
-                            self.branch_stats['#'] += 1
-                        else:
-                            self.branch_stats['>'] += 1
+                pairs.extend((branch, remote) for remote in remotes_to_status)
+
+        for (branch, remote), (localahead, remoteahead) in \
+                self.count_ahead_behind(pairs).items():
+            branch_to_remotes_to_status[branch][remote] = (localahead,
+                                                           remoteahead)
+
+        return (remote_to_branches, branch_to_remotes_to_status,
+                self.count_branch_stats(branch_to_remotes_to_status))
+
+    @staticmethod
+    def count_branch_stats(branch_to_remotes_to_status):
+        branch_stats = {'=': 0, '>': 0, '<': 0, '#': 0, '}': 0, '{': 0}
+        for remotes_to_status in branch_to_remotes_to_status.values():
+            if not remotes_to_status:
+                branch_stats['}'] += 1
+            for status in remotes_to_status.values():
+                if status is None:
+                    branch_stats['{'] += 1
+                elif status[0] > 0:
+                    if status[1] > 0:
+                        branch_stats['#'] += 1
+                    else:
+                        branch_stats['>'] += 1
+                else:
+                    if status[1] > 0:
+                        branch_stats['<'] += 1
                     else:
-                        if remoteahead > 0:
-                            self.branch_stats['<'] += 1
-                        else:
-                            self.branch_stats['='] += 1
+                        branch_stats['='] += 1
+        return branch_stats
 
-        for branch in self.branch_to_remotes_to_status:
-            for remote in self.branch_to_remotes_to_status[branch]:
-                if self.branch_to_remotes_to_status[branch][remote] is None:
-                    self.branch_stats['{'] += 1
+    def _iter_exec(self, *args, separator=b'\0'):
+        # Yield the separator-terminated records of the output as bytes, as
+        #  soon as they are read, so that huge outputs are never held in
+        #  memory at once; with separator=None the chunks are yielded as
+        #  they are read
+        timeout = self._get_timeout()
+        start = time.perf_counter()
+        process = Popen([self.COMMAND] + list(args), stdout=PIPE,
+                        cwd=self.absdirpath,
+                        start_new_session=timeout is not None)
+        watchdog = _Watchdog(process, timeout)
+        size = 0
+        tail = b''
+        try:
+            while True:
+                chunk = process.stdout.read1(65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if separator is None:
+                    yield chunk
+                    continue
+                records = (tail + chunk).split(separator)
+                tail = records.pop()
+                yield from records
+        finally:
+            process.stdout.close()
+            self._report_exec(args, start, watchdog.wait(), size)
+        self._check_watchdog(watchdog, args)
+        if tail:
+            yield tail
 
     def _exec(self, *args):
+        timeout = self._get_timeout()
+        start = time.perf_counter()
         process = Popen([self.COMMAND] + list(args), stdout=PIPE,
-                        cwd=self.absdirpath)
-        return process.stdout.read().decode()
+                        cwd=self.absdirpath,
+                        start_new_session=timeout is not None)
+        watchdog = _Watchdog(process, timeout)
+        stdout = process.stdout.read()
+        process.stdout.close()
+        self._report_exec(args, start, watchdog.wait(), len(stdout))
+        self._check_watchdog(watchdog, args)
+        return stdout.decode()
+
+    async def _aexec(self, *args):
+        timeout = self._get_timeout()
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            self.COMMAND, *args, stdout=PIPE, cwd=self.absdirpath,
+            start_new_session=timeout is not None)
+        try:
+            stdout = await self._acommunicate(process, timeout)
+        except CommandTimeout:
+            self._report_exec(args, start, process.returncode, 0)
+            self.timed_out = True
+            raise
+        self._report_exec(args, start, process.returncode, len(stdout[0]))
+        return stdout[0].decode()
+
+    @staticmethod
+    async def _acommunicate(process, timeout):
+        # Like process.communicate(), but the process group is killed and
+        #  reaped, and CommandTimeout is raised, after timeout seconds
+        try:
+            return await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            _kill_process_group(process.pid)
+            await process.wait()
+            raise CommandTimeout('Timed out after {} seconds'.format(timeout))
+
+    def _get_timeout(self):
+        # Return the timeout of the next command, which is also limited by
+        #  the deadline of the repository; once a command has timed out,
+        #  no other command is started
+        if self.timed_out:
+            raise CommandTimeout('A previous command timed out')
+        timeout = self.context.command_timeout
+        if self.context.timeout is not None:
+            now = time.monotonic()
+            if self._deadline is None:
+                self._deadline = now + self.context.timeout
+            remaining = self._deadline - now
+            if remaining <= 0:
+                self.timed_out = True
+                raise CommandTimeout('The deadline of the repository expired')
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def _check_watchdog(self, watchdog, args):
+        if watchdog.expired:
+            self.timed_out = True
+            raise CommandTimeout('{} timed out'.format(' '.join(
+                                                (self.COMMAND, ) + args)))
+
+    def _report_exec(self, args, start, returncode, output_size,
+                     forked=True):
+        if self.context.exec_hooks:
+            record = ExecRecord((self.COMMAND, ) + tuple(args),
+                                self.absdirpath,
+                                time.perf_counter() - start, returncode,
+                                output_size, forked)
+            for hook in self.context.exec_hooks:
+                hook(record)
 
 
 class _Git(_Repository):
     COMMAND = 'git'
     DOTDIR = '.git'
 
-    def do_update_remotes(self):
-        self._exec('remote', 'update')
+    OBJECT_NAME = re.compile(r'[0-9a-f]{40}(?:[0-9a-f]{24})?$')
 
-    def get_pending_changes(self):
-        uncommitted = []
-        untracked = []
-        for line in self._exec('status', '--porcelain').splitlines():
-            if line.startswith('?'):
-                untracked.append((line[:2], line[3:]))
-            else:
-                uncommitted.append((line[:2], line[3:]))
-        return (uncommitted, untracked)
+    __slots__ = ('gitdir', 'commondir')
+
+    def __init__(self, reldirpath, rel_paths, context=None):
+        super().__init__(reldirpath, rel_paths, context)
+        self.gitdir = os.path.join(self.absdirpath, self.DOTDIR)
+        # Linked worktrees and submodules have a '.git' file pointing to the
+        #  actual git directory
+        try:
+            with open(self.gitdir) as stream:
+                content = stream.read()
+        except OSError:
+            pass
+        else:
+            if content.startswith('gitdir: '):
+                self.gitdir = os.path.normpath(os.path.join(
+                    self.absdirpath, content[len('gitdir: '):].strip()))
+        try:
+            with open(os.path.join(self.gitdir, 'commondir')) as stream:
+                commondir = stream.read().strip()
+        except OSError:
+            self.commondir = self.gitdir
+        else:
+            self.commondir = os.path.normpath(os.path.join(self.gitdir,
+                                                           commondir))
+
+    def get_shared_key(self):
+        # Linked worktrees share the refs of the common git directory; the
+        #  key is only returned when there are linked worktrees, so that the
+        #  fields of the other repositories are not kept for the whole run
+        if self.gitdir == self.commondir and not os.path.isdir(
+                                os.path.join(self.commondir, 'worktrees')):
+            return None
+        return os.path.realpath(self.commondir)
+
+    def get_last_fetch_times(self):
+        # FETCH_HEAD is rewritten by every fetch, and names the URL of the
+        #  remote of every fetched ref, e.g.
+        #  "<oid>\tnot-for-merge\tbranch 'main' of <url>", or just
+        #  "<oid>\t\t<url>" for a remote's HEAD
+        path = os.path.join(self.commondir, 'FETCH_HEAD')
+        try:
+            with open(path, 'rb') as stream:
+                mtime = os.fstat(stream.fileno()).st_mtime
+                content = stream.read().decode(errors='replace')
+        except OSError:
+            return {}
+        times = {}
+        for line in content.splitlines():
+            fields = line.split('\t', 2)
+            if len(fields) < 3:
+                continue
+            description, separator, url = fields[2].partition("' of ")
+            times[url if separator else description] = mtime
+        return times
+
+    @staticmethod
+    def normalize_fetch_url(url):
+        # Like git when writing FETCH_HEAD, drop the credentials of the URLs
+        #  with a scheme, and the trailing slashes and '.git'
+        if '://' in url:
+            scheme, _, rest = url.partition('://')
+            authority, slash, path = rest.partition('/')
+            url = '{}://{}{}{}'.format(scheme, authority.rpartition('@')[2],
+                                       slash, path)
+        url = url.rstrip('/')
+        if url.endswith('.git'):
+            url = url[:-len('.git')]
+        return url
+
+    def get_object_store(self):
+        return os.path.realpath(os.path.join(self.commondir, 'objects'))
+
+    def get_alternates(self):
+        # Relative paths in objects/info/alternates are relative to the
+        #  objects directory
+        objectsdir = os.path.join(self.commondir, 'objects')
+        try:
+            with open(os.path.join(objectsdir, 'info', 'alternates')) as \
+                    stream:
+                lines = stream.read().splitlines()
+        except OSError:
+            return ()
+        return tuple(os.path.realpath(os.path.join(objectsdir, line.strip()))
+                     for line in lines
+                     if line.strip() and not line.startswith('#'))
+
+    def get_fingerprint(self):
+        # Git replaces refs by renaming lock files, so the inode number
+        #  changes even when the size and a coarse mtime do not; HEAD is left
+        #  out, as the branch status does not depend on it, and it differs
+        #  between the worktrees that share the cached fields
+        fingerprint = []
+        try:
+            stat = os.stat(os.path.join(self.commondir, 'packed-refs'))
+        except OSError:
+            fingerprint.append(None)
+        else:
+            fingerprint.append([stat.st_ino, stat.st_mtime_ns, stat.st_size])
+        refsdir = os.path.join(self.commondir, 'refs')
+        for dirpath, dirnames, filenames in os.walk(refsdir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                fingerprint.append([os.path.relpath(path, refsdir),
+                                    stat.st_ino, stat.st_mtime_ns,
+                                    stat.st_size])
+        return fingerprint
+
+    async def do_update_remotes(self, updater):
+        # Fetch the same remotes as 'git remote update' would, but one by
+        #  one, so that the updater can limit the fetches per host
+        urls = {}
+        skipped = set()
+        group = None
+        for line in (await updater.exec(
+                self, 'config', '--get-regexp', r'^(remote\..*\.(url|'
+                r'skipdefaultupdate)|remotes\.default)$')).splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'remotes.default':
+                group = value.split()
+                continue
+            remote, _, name = key[len('remote.'):].rpartition('.')
+            if name == 'url':
+                urls.setdefault(remote, value)
+            elif value.lower() in ('true', 'yes', 'on', '1'):
+                skipped.add(remote)
+        results = {}
+        for remote in urls:
+            if (group is None and remote not in skipped) or \
+                    (group is not None and remote in group):
+                result = await updater.fetch(self, remote, urls[remote],
+                                             'fetch', remote)
+                if result is not None:
+                    results[remote] = result
+        return results
+
+    def get_pending_changes(self, counts_only=False, untracked=True,
+                            untracked_cache=False, fsmonitor=False):
+        # Return (uncommitted, untracked, uncommitted_count, untracked_count,
+        #  current_branch) from a single 'git status'; with counts_only the
+        #  two lists are None and no file paths are stored at all
+        args = []
+        if untracked_cache:
+            args.extend(('-c', 'core.untrackedCache=true'))
+        if fsmonitor:
+            args.extend(('-c', 'core.fsmonitor=true'))
+        args.extend(('status', '--porcelain=v2', '--branch', '-z'))
+        # Otherwise the user's status.showUntrackedFiles applies
+        if not untracked:
+            args.append('--untracked-files=no')
+        uncommitted = None if counts_only else []
+        untracked = None if counts_only else []
+        uncommitted_count = untracked_count = 0
+        oid = head = None
+        records = self._iter_exec(*args)
+        for record in records:
+            type_ = record[:1]
+            if type_ == b'?':
+                untracked_count += 1
+                if not counts_only:
+                    untracked.append(('??', os.fsdecode(record[2:])))
+            elif type_ in (b'1', b'2', b'u'):
+                uncommitted_count += 1
+                # Renames and copies are followed by a record with the
+                #  original path, which must be consumed anyway
+                origpath = next(records) if type_ == b'2' else None
+                if not counts_only:
+                    # The number of fields before the path depends on the
+                    #  record type
+                    fields = record.split(b' ', {b'1': 8, b'2': 9,
+                                                 b'u': 10}[type_])
+                    # Use the same format as '--porcelain=v1'
+                    status = fields[1].decode().replace('.', ' ')
+                    filepath = os.fsdecode(fields[-1])
+                    if origpath is not None:
+                        filepath = ' -> '.join((os.fsdecode(origpath),
+                                                filepath))
+                    uncommitted.append((status, filepath))
+            elif record.startswith(b'# branch.oid '):
+                oid = record[len(b'# branch.oid '):].decode()
+            elif record.startswith(b'# branch.head '):
+                head = os.fsdecode(record[len(b'# branch.head '):])
+        # Like 'git rev-parse --abbrev-ref HEAD', also report 'HEAD' for
+        #  unborn branches
+        current_branch = None if head is None else 'HEAD' if head == \
+            '(detached)' or oid == '(initial)' else head
+        return (uncommitted, untracked, uncommitted_count, untracked_count,
+                current_branch)
 
     def get_current_branch(self):
+        headpath = os.path.join(self.gitdir, 'HEAD')
+        head = None
+        # Legacy symlinked HEADs and the reftable backend, whose HEAD is
+        #  only a placeholder, are left to git
+        if not os.path.islink(headpath) and not self._has_reftable():
+            try:
+                with open(headpath) as stream:
+                    head = stream.read().strip()
+            except OSError:
+                pass
+        if head is not None:
+            if head.startswith('ref: refs/heads/'):
+                refname = head[len('ref: '):]
+                if refname in self._list_refs('refs/heads/'):
+                    return refname[len('refs/heads/'):]
+                # Like 'git rev-parse --abbrev-ref HEAD' on an unborn branch
+                return 'HEAD'
+            if self.OBJECT_NAME.match(head):
+                # Detached HEAD
+                return 'HEAD'
         return self._exec('rev-parse', '--abbrev-ref', 'HEAD').strip()
 
     def iter_local_branches(self):
-        return (branch[2:] for branch in self._exec('branch', '--no-color'
-                                                    ).splitlines())
+        return (refname[len('refs/heads/'):]
+                for refname in self._list_refs('refs/heads/'))
 
     def iter_remote_branches(self):
-        for line in self._exec('branch', '--remotes', '--no-color'
-                               ).splitlines():
-            remote, branch = line[2:].split('/', maxsplit=1)
-            # It's important to also look for a space after 'HEAD'
-            if branch[:5] != 'HEAD ':
+        for refname, target in self._list_refs('refs/remotes/').items():
+            # Skip symbolic refs such as 'refs/remotes/origin/HEAD'
+            if target is None or not target.startswith('ref: '):
+                remote, branch = refname[len('refs/remotes/'):].split(
+                    '/', maxsplit=1)
                 yield (remote, branch)
 
-    def count_commits_ahead(self, branch_ahead, branch_behind):
-        # 'git rev-list' with the '..' notation actually only tells which
-        #  commits are in branch_ahead but not in branch_behind, which means
-        #  that the two branches may be diverging, and the reverse command
-        #  should be executed too
-        return len(self._exec('rev-list',
-                   '..'.join((branch_behind, branch_ahead))).splitlines())
+    def _list_refs(self, prefix):
+        # Return a {refname: target} dictionary, sorted by refname, of the
+        #  refs under prefix; target is 'ref: <refname>' for symbolic refs
+        refs = self._read_refs(prefix)
+        if refs is None:
+            refs = {}
+            for line in self._exec('for-each-ref',
+                                   '--format=%(refname)%00%(symref)',
+                                   prefix.rstrip('/')).splitlines():
+                refname, symref = line.split('\0')
+                refs[refname] = 'ref: ' + symref if symref else None
+        return refs
+
+    def _read_refs(self, prefix):
+        # Read the ref store directly instead of forking git; return None if
+        #  its format is not understood
+        if self._has_reftable():
+            return None
+        refs = {}
+        try:
+            with open(os.path.join(self.commondir, 'packed-refs')) as stream:
+                for line in stream:
+                    # Skip the header and the peeled tags
+                    if line.startswith(('#', '^')):
+                        continue
+                    objectname, _, refname = line.rstrip('\n').partition(' ')
+                    if refname.startswith(prefix):
+                        refs[refname] = objectname
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return None
+        # Loose refs take precedence over packed ones
+        for dirpath, dirnames, filenames in os.walk(os.path.join(
+                                    self.commondir, *prefix.split('/'))):
+            for filename in filenames:
+                if filename.endswith('.lock'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    with open(path) as stream:
+                        target = stream.read().strip()
+                except (OSError, UnicodeDecodeError):
+                    continue
+                # Ignore broken refs, like git does
+                if target.startswith('ref: ') or \
+                        self.OBJECT_NAME.match(target):
+                    refname = os.path.relpath(path, self.commondir)
+                    refs[refname.replace(os.sep, '/')] = target
+        return dict(sorted(refs.items()))
+
+    def _has_reftable(self):
+        return os.path.isdir(os.path.join(self.commondir, 'reftable'))
+
+    def count_ahead_behind(self, pairs):
+        # Return a {(branch, remote): (localahead, remoteahead)} dictionary
+        #  for all the given pairs
+        counts = {}
+        pending = set(pairs)
+        # Most local branches track the remote branch with the same name, so
+        #  a single 'git for-each-ref' can already give their counts
+        for line in self._exec('for-each-ref', '--format=%(refname)%00'
+                               '%(upstream)%00%(upstream:track,nobracket)',
+                               'refs/heads').splitlines():
+            refname, upstream, track = line.split('\0')
+            if not upstream.startswith('refs/remotes/'):
+                continue
+            branch = refname[len('refs/heads/'):]
+            remote, rbranch = upstream[len('refs/remotes/'):].split(
+                '/', maxsplit=1)
+            if (branch, remote) not in pending or rbranch != branch or \
+                    track == 'gone':
+                continue
+            localahead = remoteahead = 0
+            for item in track.split(', ') if track else ():
+                key, count = item.split(' ')
+                if key == 'ahead':
+                    localahead = int(count)
+                else:
+                    remoteahead = int(count)
+            counts[(branch, remote)] = (localahead, remoteahead)
+            pending.discard((branch, remote))
+        for branch, remote in pending:
+            # The '...' notation with '--left-right' counts both the commits
+            #  that are only in the local branch (left) and those that are
+            #  only in the remote one (right), since the two branches may be
+            #  diverging
+            output = self._exec('rev-list', '--left-right', '--count',
+                                '...'.join(('refs/heads/' + branch,
+                                            '/'.join(('refs/remotes', remote,
+                                                      branch))))).split()
+            try:
+                localahead, remoteahead = output
+            except ValueError:
+                # 'git rev-list' failed, e.g. because of a broken ref
+                localahead = remoteahead = 0
+            counts[(branch, remote)] = (int(localahead), int(remoteahead))
+        return counts
+
+
+class _HgCommandServer:
+    # A persistent 'hg serve --cmdserver pipe' process: Mercurial's startup
+    #  time is only paid once, instead of for every command
+
+    def __init__(self, dirpath, env, timeout=None):
+        # With a timeout, the server is killed, and CommandTimeout raised,
+        #  if it does not start in time
+        self.process = Popen(['hg', 'serve', '--cmdserver', 'pipe',
+                              '--config', 'ui.interactive=False'],
+                             stdin=PIPE, stdout=PIPE, cwd=dirpath, env=env,
+                             start_new_session=timeout is not None)
+        # The server starts by announcing its capabilities
+        channel, hello = self._call(self._read_channel, timeout)
+        if channel != b'o' or b'runcommand' not in hello:
+            self.close()
+            raise EOFError('Unexpected Mercurial command server greeting')
+
+    def runcommand(self, *args, timeout=None):
+        # Return (returncode, output) for the command; with a timeout, the
+        #  server is killed, and CommandTimeout raised, if the command does
+        #  not complete in time
+        return self._call(lambda: self._runcommand(args), timeout)
+
+    def _call(self, function, timeout):
+        watchdog = _Watchdog(self.process, timeout)
+        try:
+            result = function()
+        except (EOFError, OSError):
+            # The pipes are closed when the server is killed
+            if not watchdog.expired:
+                raise
+        finally:
+            watchdog.cancel()
+        if watchdog.expired:
+            self.close()
+            raise CommandTimeout('The Mercurial command server timed out')
+        return result
+
+    def _runcommand(self, args):
+        data = b'\0'.join(os.fsencode(arg) for arg in args)
+        self.process.stdin.write(b'runcommand\n' + struct.pack('>I', len(data))
+                                 + data)
+        self.process.stdin.flush()
+        output = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == b'o':
+                output.append(data)
+            elif channel == b'r':
+                return (struct.unpack('>i', data)[0], b''.join(output))
+            elif channel in (b'I', b'L'):
+                # Never answer prompts
+                self.process.stdin.write(struct.pack('>I', 0))
+                self.process.stdin.flush()
+            elif channel.isupper():
+                # Required channels that are not understood cannot be
+                #  ignored
+                self.close()
+                raise EOFError('Unsupported Mercurial command server '
+                               'channel: {}'.format(channel.decode()))
+            # Optional channels, e.g. 'e' for errors, are ignored
+
+    def _read_channel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            raise EOFError('The Mercurial command server exited')
+        channel, length = struct.unpack('>cI', header)
+        # Input requests are followed by no data: length is the maximum size
+        #  of the answer
+        if channel in (b'I', b'L'):
+            return (channel, None)
+        return (channel, self.process.stdout.read(length))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.stdout.close()
+        self.process.wait()
 
 
 class _Mercurial(_Repository):
-    # TODO: Implement and add to RepoCheck.INSTALLED_VCS
-    #       Also update README.md
-    #       (bug #7)
-    pass
+    COMMAND = 'hg'
+    DOTDIR = '.hg'
+    __slots__ = ('_server', )
+
+    def __init__(self, reldirpath, rel_paths, context=None):
+        self._server = None
+        super().__init__(reldirpath, rel_paths, context)
+
+    def inspect(self):
+        self._with_server(super().inspect)
+
+    def _get_workspace(self):
+        if self._workspace is None:
+            self._with_server(super()._get_workspace)
+        return self._workspace
+
+    def _get_branches(self):
+        if self._branches is None:
+            self._with_server(super()._get_branches)
+        return self._branches
+
+    def _with_server(self, function):
+        # Run all the commands needed by function through a single command
+        #  server, which is stopped afterwards so that no process outlives
+        #  the computation of the fields
+        if self._server is not None:
+            return function()
+        try:
+            timeout = self._get_timeout()
+            start = time.perf_counter()
+            self._server = _HgCommandServer(self.absdirpath, self._get_env(),
+                                            timeout)
+        except CommandTimeout:
+            # The commands of function then fail at once, and the fields
+            #  are unknown
+            self.timed_out = True
+            return function()
+        except (EOFError, OSError):
+            # Fall back to one process per command
+            self._report_exec(('serve', '--cmdserver', 'pipe'), start, None,
+                              0)
+            return function()
+        self._report_exec(('serve', '--cmdserver', 'pipe'), start, 0, 0)
+        try:
+            return function()
+        finally:
+            if self._server is not None:
+                self._server.close()
+                self._server = None
+
+    @staticmethod
+    def _get_env():
+        # HGPLAIN disables the user's output customizations
+        return dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+
+    def _run(self, *args):
+        # Return (returncode, output) for the command, using the command
+        #  server if it is running
+        timeout = self._get_timeout()
+        start = time.perf_counter()
+        if self._server is not None:
+            try:
+                returncode, output = self._server.runcommand(*args,
+                                                             timeout=timeout)
+            except CommandTimeout:
+                self._report_exec(args, start, -signal.SIGKILL, 0, False)
+                self.timed_out = True
+                raise
+            except (EOFError, OSError):
+                # The server died or cannot be understood: the remaining
+                #  commands, this one included, use one process each
+                self._report_exec(args, start, None, 0, False)
+                self._server.close()
+                self._server = None
+                return self._run(*args)
+            self._report_exec(args, start, returncode, len(output), False)
+            return (returncode, output)
+        process = Popen([self.COMMAND] + list(args), stdout=PIPE,
+                        cwd=self.absdirpath, env=self._get_env(),
+                        start_new_session=timeout is not None)
+        watchdog = _Watchdog(process, timeout)
+        output = process.stdout.read()
+        process.stdout.close()
+        returncode = watchdog.wait()
+        self._report_exec(args, start, returncode, len(output))
+        self._check_watchdog(watchdog, args)
+        return (returncode, output)
+
+    def _exec(self, *args):
+        return self._run(*args)[1].decode()
+
+    def get_fingerprint(self):
+        # The branch status depends on the state of the paths themselves,
+        #  which cannot be fingerprinted locally, so it is never cached
+        return None
+
+    async def do_update_remotes(self, updater):
+        # Like 'git remote update', 'hg pull' does not touch the working
+        #  directory
+        results = {}
+        output = await updater.exec(self, 'paths')
+        for path, url in self._parse_paths(output):
+            result = await updater.fetch(self, path, url, 'pull', path)
+            if result is not None:
+                results[path] = result
+        return results
+
+    def iter_paths(self):
+        return self._parse_paths(self._exec('paths'))
+
+    @staticmethod
+    def _parse_paths(output):
+        for line in output.splitlines():
+            path, _, url = line.partition(' = ')
+            if url:
+                yield (path, url)
+
+    def get_pending_changes(self, counts_only=False, untracked=True,
+                            untracked_cache=False, fsmonitor=False):
+        # untracked_cache and fsmonitor only apply to git; Mercurial's
+        #  fsmonitor extension is enabled in its own configuration
+        uncommitted = None if counts_only else []
+        untracked_files = None if counts_only else []
+        uncommitted_count = untracked_count = 0
+        # Without untracked files, list modified, added, removed and missing
+        #  files, i.e. the default minus '?'
+        args = ('status', '--print0') if untracked else ('status', '--print0',
+                                                         '-mard')
+        for record in self._run(*args)[1].split(b'\0'):
+            if not record:
+                continue
+            status = record[:1].decode()
+            if status == '?':
+                untracked_count += 1
+                if not counts_only:
+                    untracked_files.append((status, os.fsdecode(record[2:])))
+            else:
+                uncommitted_count += 1
+                if not counts_only:
+                    uncommitted.append((status, os.fsdecode(record[2:])))
+        return (uncommitted, untracked_files, uncommitted_count,
+                untracked_count, self.get_current_branch())
+
+    def get_current_branch(self):
+        # The active bookmark, if any, is what is being committed to
+        return self._exec('log', '-r', '.', '-T',
+                          '{if(activebookmark, activebookmark, branch)}')
+
+    def iter_local_branches(self):
+        # Only the open named branches
+        return iter(sorted(self._exec('branches', '-q').splitlines()))
+
+    def inspect_branches(self):
+        # Mercurial has no remote-tracking refs, so the paths themselves are
+        #  asked which changesets of every branch are missing on either side
+        remote_to_branches = {}
+        branch_to_remotes_to_status = {branch: {} for branch in
+                                       self.iter_local_branches()}
+        for path, url in self.iter_paths():
+            outgoing = self._count_changesets('outgoing', path)
+            incoming = self._count_changesets('incoming', path)
+            # Skip the paths that cannot be reached
+            if outgoing is None or incoming is None:
+                continue
+            for branch, remotes_to_status in \
+                    branch_to_remotes_to_status.items():
+                remotes_to_status[path] = (outgoing.get(branch, 0),
+                                           incoming.get(branch, 0))
+            # Branches that only exist in the path have never been pulled
+            for branch in incoming:
+                if branch not in branch_to_remotes_to_status:
+                    branch_to_remotes_to_status[branch] = {path: None}
+            remote_to_branches[path] = sorted(branch for branch in
+                                              branch_to_remotes_to_status
+                                              if path in
+                                              branch_to_remotes_to_status[
+                                                                    branch])
+        return (remote_to_branches, branch_to_remotes_to_status,
+                self.count_branch_stats(branch_to_remotes_to_status))
+
+    def _count_changesets(self, command, path):
+        # Return a {branch: changesets} dictionary, or None on errors
+        returncode, output = self._run(command, '-q', '-T', '{branch}\\n',
+                                       path)
+        # 'hg incoming' and 'hg outgoing' return 1 if there are no changesets
+        if returncode not in (0, 1):
+            return None
+        counts = {}
+        for branch in output.decode().splitlines():
+            counts[branch] = counts.get(branch, 0) + 1
+        return counts
 
 
 class _Subversion(_Repository):
-    # TODO: Implement and add to RepoCheck.INSTALLED_VCS
-    #       Also update README.md
-    #       (bug #7)
-    pass
+    COMMAND = 'svn'
+    DOTDIR = '.svn'
+    # 'svn status' and 'svn info' accept many working copies at once, so
+    #  they are inspected in batches, with two commands per batch
+    BATCH_SIZE = 32
+    # Subversion has no remote branches: the working copy is compared with
+    #  the repository it was checked out from
+    REMOTE = 'repository'
+
+    # The letters of the text output of 'svn status', for the item and the
+    #  properties columns
+    ITEM_STATUS = {'added': 'A', 'conflicted': 'C', 'deleted': 'D',
+                   'incomplete': '!', 'merged': 'G', 'missing': '!',
+                   'modified': 'M', 'obstructed': '~', 'replaced': 'R'}
+    PROPS_STATUS = {'conflicted': 'C', 'modified': 'M'}
+
+    __slots__ = ()
+
+    def inspect(self):
+        self.inspect_batch((self, ))
+
+    def _get_workspace(self):
+        if self._workspace is None:
+            self.inspect_batch((self, ))
+        return self._workspace
+
+    def _get_branches(self):
+        if self._branches is None:
+            self.inspect_batch((self, ))
+        return self._branches
+
+    @classmethod
+    def inspect_batch(cls, repos):
+        # Compute all the fields of the working copies, which must share the
+        #  same context, with a single 'svn info' and a single 'svn status'
+        repos = [repo for repo in repos if repo._workspace is None or
+                 repo._branches is None]
+        if not repos:
+            return
+        start = time.perf_counter()
+
+        def get_runner():
+            # The commands of a batch are run from the first working copy,
+            #  with absolute paths, but each by a separate instance, so that
+            #  it has a deadline of its own
+            if len(repos) == 1:
+                return repos[0]
+            return cls(repos[0].absdirpath, False, repos[0].context)
+
+        branches = get_runner().get_branch_names(repos)
+        statuses = get_runner().get_statuses(repos,
+                                             **repos[0].context.status_options)
+        # The commands are shared, and so is their time
+        inspect_time = (time.perf_counter() - start) / len(repos)
+        for repo in repos:
+            repo.inspect_time += inspect_time
+            if repo.timed_out:
+                repo._workspace = cls.UNKNOWN_WORKSPACE
+                repo._branches = cls.UNKNOWN_BRANCHES
+                continue
+            uncommitted, untracked, uncommitted_count, untracked_count, \
+                behind = statuses[repo.absdirpath]
+            branch = branches.get(repo.absdirpath)
+            repo._workspace = (uncommitted, untracked, uncommitted_count,
+                               untracked_count, branch)
+            # Without --show-updates nothing is known about the repository,
+            #  which is then left out rather than reported as unfetched
+            if branch is None or behind is None:
+                branch_to_remotes_to_status = {}
+                remote_to_branches = {}
+            else:
+                branch_to_remotes_to_status = {branch: {cls.REMOTE: (0,
+                                                                     behind)}}
+                remote_to_branches = {cls.REMOTE: [branch]}
+            repo._branches = (remote_to_branches, branch_to_remotes_to_status,
+                              cls.count_branch_stats(
+                                                branch_to_remotes_to_status))
+
+    def get_fingerprint(self):
+        # The working copy metadata is a database that changes with the
+        #  workspace, so nothing is cached
+        return None
+
+    async def do_update_remotes(self, updater):
+        # There is nothing to fetch: with update_remotes the repository is
+        #  queried by 'svn status --show-updates' during the inspection
+        return None
+
+    def get_branch_names(self, repos):
+        # Return an {absdirpath: branch} dictionary from a single 'svn info'
+        branches = {}
+        try:
+            self._read_branch_names(repos, branches)
+        except CommandTimeout:
+            # Retry alone the working copies that were not reached, so that
+            #  a hung one does not make the whole batch unknown
+            if len(repos) > 1:
+                for repo in repos:
+                    if repo.absdirpath not in branches:
+                        try:
+                            repo._read_branch_names((repo, ), branches)
+                        except CommandTimeout:
+                            pass
+        return branches
+
+    def _read_branch_names(self, repos, branches):
+        for entry, _ in self._iter_xml(
+                ('entry', ), 'info', '--xml', '--non-interactive',
+                *(repo.absdirpath for repo in repos)):
+            relative_url = entry.findtext('relative-url')
+            if relative_url is None:
+                # Subversion before 1.8
+                url = entry.findtext('url') or ''
+                root = entry.findtext('repository/root') or ''
+                relative_url = '^' + url[len(root):]
+            branches[os.path.normpath(entry.get('path'))] = \
+                self.get_branch_name(unquote(relative_url))
+
+    @staticmethod
+    def get_branch_name(relative_url):
+        # Follow the conventional trunk, branches and tags layout, also in
+        #  repositories with many projects
+        parts = [part for part in relative_url.lstrip('^').split('/') if part]
+        for index, part in enumerate(parts):
+            if part == 'trunk':
+                return part
+            if part in ('branches', 'tags') and index + 1 < len(parts):
+                return parts[index + 1]
+        return '/' + '/'.join(parts)
+
+    def get_statuses(self, repos, counts_only=False, untracked=True,
+                     untracked_cache=False, fsmonitor=False):
+        # Return an {absdirpath: (uncommitted, untracked, uncommitted_count,
+        #  untracked_count, behind)} dictionary from a single 'svn status';
+        #  behind is the number of items that are out of date, or None if the
+        #  repository was not queried
+        # untracked_cache and fsmonitor only apply to git
+        def empty_status():
+            return [None if counts_only else [], None if counts_only else [],
+                    0, 0, None]
+
+        # The working copies that already timed out are left out
+        repos = [repo for repo in repos if not repo.timed_out]
+        statuses = {repo.absdirpath: empty_status() for repo in repos}
+        show_updates = self.context.update_remotes
+        done = set()
+        try:
+            self._parse_statuses(repos, statuses, done, counts_only,
+                                 untracked, show_updates)
+        except CommandTimeout:
+            pass
+        # svn stops at the first working copy that fails, e.g. because its
+        #  server cannot be reached, and a batch can time out because of a
+        #  single hung working copy: the unfinished ones are retried alone,
+        #  and then without querying the server
+        retries = [show_updates] if len(repos) > 1 else []
+        if show_updates:
+            retries.append(False)
+        for repo in repos:
+            for retry_updates in retries:
+                if repo.absdirpath in done:
+                    break
+                statuses[repo.absdirpath] = empty_status()
+                try:
+                    repo._parse_statuses((repo, ), statuses, done,
+                                         counts_only, untracked,
+                                         retry_updates)
+                except CommandTimeout:
+                    break
+        return {absdirpath: tuple(status) for absdirpath, status in
+                statuses.items()}
+
+    def _parse_statuses(self, repos, statuses, done, counts_only, untracked,
+                        show_updates):
+        # Update statuses in place, and add to done the working copies whose
+        #  status was read completely
+        args = ['status', '--xml', '--non-interactive', '--ignore-externals']
+        if not untracked:
+            args.append('--quiet')
+        if show_updates:
+            args.append('--show-updates')
+        args.extend(repo.absdirpath for repo in repos)
+        for element, target in self._iter_xml(('entry', 'against', 'target'),
+                                              *args):
+            if element.tag == 'target':
+                done.add(os.path.normpath(element.get('path')))
+                continue
+            if target is None:
+                continue
+            target = os.path.normpath(target.get('path'))
+            try:
+                status = statuses[target]
+            except KeyError:
+                continue
+            if element.tag == 'against':
+                status[4] = status[4] or 0
+                continue
+            wcstatus = element.find('wc-status')
+            reposstatus = element.find('repos-status')
+            if reposstatus is not None and (
+                    reposstatus.get('item') not in ('none', 'normal') or
+                    reposstatus.get('props') not in ('none', 'normal')):
+                status[4] = (status[4] or 0) + 1
+            if wcstatus is None:
+                continue
+            item = wcstatus.get('item')
+            if item == 'unversioned':
+                status[3] += 1
+                if not counts_only:
+                    status[1].append(('?', os.path.relpath(
+                                            element.get('path'), target)))
+                continue
+            code = self.ITEM_STATUS.get(item, ' ') + self.PROPS_STATUS.get(
+                                                    wcstatus.get('props'), ' ')
+            if code != '  ':
+                status[2] += 1
+                if not counts_only:
+                    status[0].append((code, os.path.relpath(
+                                            element.get('path'), target)))
+
+    def _iter_xml(self, tags, *args):
+        # Parse the XML output incrementally, as it is read, and yield
+        #  (element, target) for the complete elements with one of the tags,
+        #  where target is the nearest enclosing 'target' element, if any,
+        #  e.g. also for the entries of 'svn status' inside a 'changelist';
+        #  they are then removed from the tree, so that memory does not grow
+        #  with the size of the output
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        stack = []
+        for chunk in self._iter_exec(*args, separator=None):
+            try:
+                parser.feed(chunk)
+            except ElementTree.ParseError:
+                return
+            for event, element in parser.read_events():
+                if event == 'start':
+                    stack.append(element)
+                    continue
+                stack.pop()
+                if element.tag in tags:
+                    yield (element, next((ancestor for ancestor in
+                                          reversed(stack)
+                                          if ancestor.tag == 'target'), None))
+                    if stack:
+                        stack[-1].remove(element)
+
+
+class _BufferedWriter:
+    def __init__(self, stream, size=65536):
+        # Collect the written text, and write it to stream in chunks of at
+        #  least size characters
+        self.stream = stream
+        self.size = size
+        self.chunks = []
+        self.length = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.stream.write(''.join(self.chunks))
+            self.chunks = []
+            self.length = 0
+        self.stream.flush()
 
 
 class Viewer:
+    COLOR_NAMES = ('RED', 'REDBOLD', 'GREEN', 'GREENBOLD', 'YELLOW',
+                   'YELLOWBOLD', 'BLUE', 'BLUEBOLD', 'PURPLE', 'PURPLEBOLD',
+                   'CYAN', 'CYANBOLD', 'WHITE', 'WHITEBOLD', 'RESET')
+    # The color of every symbol, by name
+    SYMBOL_COLORS = {'*': 'RED', '?': 'CYAN', '!': 'YELLOW', '=': 'GREEN',
+                     '>': 'RED', '<': 'CYAN', '#': 'RED', '}': 'RED',
+                     '{': 'GREEN'}
+    # The branch stats of the short view, in display order, and whether
+    #  they are only displayed with all_; the other ones require action
+    SHORT_BRANCH_STATS = (('=', True), ('{', True), ('<', False),
+                          ('>', False), ('#', False), ('}', False))
+    # The escapes used by git's quoting of paths
+    PATH_ESCAPES = {'\a': '\\a', '\b': '\\b', '\t': '\\t', '\n': '\\n',
+                    '\v': '\\v', '\f': '\\f', '\r': '\\r', '"': '\\"',
+                    '\\': '\\\\'}
+
     def __init__(self, repos):
+        # repos can be a {absdirpath: repo} dictionary like RepoCheck.repos,
+        #  which is displayed in sorted order, or any iterable of
+        #  repositories like RepoCheck.iter_repos(), which is displayed in
+        #  its own order as it is consumed
         self.repos = repos
 
+    @classmethod
+    def quote_path(cls, path):
+        # Like git's quoting of paths, return path in double quotes, with
+        #  C-style escapes, if it has characters that are not printable or
+        #  that could not be decoded, so that they cannot break the output
+        #  or control the terminal; printable non-ASCII characters are kept
+        if path.isprintable() and '"' not in path and '\\' not in path:
+            return path
+        chars = []
+        for char in path:
+            try:
+                chars.append(cls.PATH_ESCAPES[char])
+            except KeyError:
+                if char.isprintable():
+                    chars.append(char)
+                else:
+                    chars.extend('\\{:03o}'.format(byte) for byte in
+                                 os.fsencode(char))
+        return '"{}"'.format(''.join(chars))
+
     @staticmethod
     def get_colors(no_colors):
         # TODO: Move to lib.py.console-colors repository
@@ -220,176 +2034,299 @@ Branch symbols:
     {cyan}<{reset}: local branch behind the remote
     {red}#{reset}: local branch diverging from the remote
     {red}}}{reset}: local branch never pushed to the remote
-    {green}{{{reset}: remote branch never fetched""".format(
-                                green=GREEN, cyan=CYAN, red=RED, reset=RESET))
+    {green}{{{reset}: remote branch never fetched
+Repository symbols:
+    {yellow}!{reset}: unknown status, a command timed out""".format(
+                                green=GREEN, cyan=CYAN, red=RED, yellow=YELLOW,
+                                reset=RESET))
 
     def display_results(self, expanded=False, all_=False, no_colors=False):
         # display_results's arguments must match the argparse attributes and
         #  their default values
-        INDENT = ' ' * 4
-        RED, REDBOLD, GREEN, GREENBOLD, YELLOW, YELLOWBOLD, BLUE, \
-            BLUEBOLD, PURPLE, PURPLEBOLD, CYAN, CYANBOLD, WHITE, \
-            WHITEBOLD, RESET = self.get_colors(no_colors)
+        self.dump(sys.stdout, expanded, all_, no_colors)
+
+    def dump(self, stream, expanded=False, all_=False, no_colors=False):
+        # The output is written in large chunks, except on terminals, where
+        #  every repository is written as soon as it is available
+        colors, symbol_colors, symbols = self.get_table(no_colors)
+        formatf = self._format_expanded if expanded else self._format_short
+        writer = _BufferedWriter(stream)
+        interactive = stream.isatty()
 
-        def color(text, COLOR):
-            return ''.join((COLOR, text, RESET))
+        if isinstance(self.repos, dict):
+            repos = (self.repos[repopath]
+                     for repopath in sorted(self.repos.keys()))
+        else:
+            repos = self.repos
 
-        displayf = self._display_expanded if expanded else self._display_short
+        for repo in repos:
+            writer.write(formatf(repo, all_, colors, symbol_colors, symbols))
+            if interactive:
+                writer.flush()
+        writer.flush()
 
-        for repopath in sorted(self.repos.keys()):
-            displayf(self.repos[repopath], all_, INDENT, color, RED, REDBOLD,
-                     GREEN, GREENBOLD, YELLOW, YELLOWBOLD, BLUE, BLUEBOLD,
-                     PURPLE, PURPLEBOLD, CYAN, CYANBOLD, WHITE, WHITEBOLD,
-                     RESET)
+    @classmethod
+    def get_table(cls, no_colors=False):
+        # Return ({color name: code}, {symbol: code}, {symbol: colored
+        #  symbol}), computed once per output instead of once per line
+        colors = dict(zip(cls.COLOR_NAMES, cls.get_colors(no_colors)))
+        symbol_colors = {symbol: colors[name]
+                         for symbol, name in cls.SYMBOL_COLORS.items()}
+        symbols = {symbol: ''.join((code, symbol, colors['RESET']))
+                   for symbol, code in symbol_colors.items()}
+        return (colors, symbol_colors, symbols)
 
-    def _display_expanded(self, repo, all_, INDENT, color, RED, REDBOLD, GREEN,
-                          GREENBOLD, YELLOW, YELLOWBOLD, BLUE, BLUEBOLD,
-                          PURPLE, PURPLEBOLD, CYAN, CYANBOLD, WHITE, WHITEBOLD,
-                          RESET):
+    def _format_expanded(self, repo, all_, colors, symbol_colors, symbols):
+        # Return the lines of the repository, or '' if it is not displayed
+        INDENT = ' ' * 4
+        RESET = colors['RESET']
         workspace = []
         branches = []
         action_required = False
 
-        for status, filepath in repo.uncommitted:
-            workspace.append('{} {}'.format(color(status, RED), filepath))
+        # The fields of the repositories that timed out may be None
+        for status, filepath in repo.uncommitted or ():
+            # Renames and copies show both paths, each quoted on its own
+            if 'R' in status or 'C' in status:
+                origpath, arrow, filepath = filepath.rpartition(' -> ')
+                filepath = ''.join((self.quote_path(origpath), arrow,
+                                    self.quote_path(filepath)))
+            else:
+                filepath = self.quote_path(filepath)
+            workspace.append(''.join((INDENT * 2, symbol_colors['*'], status,
+                                      RESET, ' ', filepath, '\n')))
             action_required = True
-        for status, filepath in repo.untracked:
-            workspace.append('{} {}'.format(color(status, CYAN), filepath))
+        for status, filepath in repo.untracked or ():
+            workspace.append(''.join((INDENT * 2, symbol_colors['?'], status,
+                                      RESET, ' ', self.quote_path(filepath),
+                                      '\n')))
             action_required = True
 
-        if len(repo.remote_to_branches) > 1:
-            for branch in sorted(repo.branch_to_remotes_to_status.keys()):
-                branchstr = color(branch, GREEN) \
-                            if branch == repo.current_branch \
-                            else branch
-                if len(repo.branch_to_remotes_to_status[branch]) == 0:
-                    branches.append('{} {}'.format(color('}', RED), branchstr))
-                    action_required = True
-                else:
-                    for remote in sorted(repo.branch_to_remotes_to_status[
-                                                                    branch]):
-                        status = repo.branch_to_remotes_to_status[branch][
-                                                                        remote]
-                        if status is None:
-                            if all_:
-                                branches.append('{} {} ({})'.format(color('{',
-                                                GREEN), branchstr, remote))
-                        else:
-                            if status[0] > 0:
-                                if status[1] > 0:
-                                    branches.append('{} {} ({}) {}'.format(
-                                        color('#', RED), branchstr, remote,
-                                        color('|'.join((str(status[0]),
-                                              str(status[1]))), YELLOW)))
-                                else:
-                                    branches.append('{} {} ({}) {}'.format(
-                                        color('>', RED), branchstr, remote,
-                                        color(str(status[0]), YELLOW)))
-                                action_required = True
-                            elif status[1] > 0:
-                                branches.append('{} {} ({}) {}'.format(
-                                    color('<', CYAN), branchstr, remote,
-                                    color(str(status[1]), YELLOW)))
-                                action_required = True
-                            elif all_:
-                                branches.append('{} {} ({})'.format(
-                                    color('=', GREEN), branchstr, remote))
-        else:
-            for branch in sorted(repo.branch_to_remotes_to_status.keys()):
-                branchstr = color(branch, GREEN) \
-                            if branch == repo.current_branch \
-                            else branch
-                if len(repo.branch_to_remotes_to_status[branch]) == 0:
-                    branches.append('{} {}'.format(color('}', RED), branchstr))
-                    action_required = True
-                else:
-                    remote = tuple(repo.branch_to_remotes_to_status[branch
-                                                                    ].keys()
-                                   )[0]
-                    status = repo.branch_to_remotes_to_status[branch][remote]
-                    if status is None:
-                        if all_:
-                            branches.append('{} {}'.format(color('{', GREEN),
-                                            branchstr))
-                    else:
-                        if status[0] > 0:
-                            if status[1] > 0:
-                                branches.append('{} {} {}'.format(color('#',
-                                                                        RED),
-                                                branchstr, color('|'.join((
-                                                    str(status[0]),
-                                                    str(status[1]))), YELLOW)))
-                            else:
-                                branches.append('{} {} {}'.format(color('>',
-                                                                        RED),
-                                                branchstr, color(
-                                                    str(status[0]), YELLOW)))
-                            action_required = True
-                        elif status[1] > 0:
-                            branches.append('{} {} {}'.format(
-                                color('<', CYAN),
-                                branchstr, color(str(status[1]),
-                                                 YELLOW)))
-                            action_required = True
-                        elif all_:
-                            branches.append('{} {}'.format(
-                                color('=', GREEN), branchstr))
+        if repo.timed_out:
+            branches.append(''.join((INDENT, symbols['!'],
+                                     ' unknown status\n')))
+            action_required = True
+
+        # With a single remote, the remote is not displayed, and only the
+        #  first status of every branch is considered
+        multiple_remotes = len(repo.remote_to_branches or ()) > 1
+        branch_to_remotes_to_status = repo.branch_to_remotes_to_status or {}
+        for branch in sorted(branch_to_remotes_to_status.keys()):
+            branchstr = ''.join((colors['GREEN'], branch, RESET)) \
+                        if branch == repo.current_branch else branch
+            remotes_to_status = branch_to_remotes_to_status[branch]
+            if len(remotes_to_status) == 0:
+                branches.append(''.join((INDENT, symbols['}'], ' ',
+                                         branchstr, '\n')))
+                action_required = True
+                continue
+            if multiple_remotes:
+                remotes = sorted(remotes_to_status)
+            else:
+                remotes = (tuple(remotes_to_status.keys())[0], )
+            for remote in remotes:
+                line, action = self._format_branch(
+                                    branchstr,
+                                    remote if multiple_remotes else None,
+                                    remotes_to_status[remote], all_, colors,
+                                    symbols)
+                if line is not None:
+                    branches.append(''.join((INDENT, line, '\n')))
+                action_required |= action
 
         if action_required:
-            print(color(repo.displayname, REDBOLD))
-            if workspace:
-                for line in workspace:
-                    print(INDENT * 2 + line)
-            for line in branches:
-                print(INDENT + line)
+            header = ''.join((colors['REDBOLD'], repo.displayname, RESET,
+                              '\n'))
         elif all_:
-            print(color(repo.displayname, GREENBOLD))
-            if workspace:
-                for line in workspace:
-                    print(INDENT * 2 + line)
-            for line in branches:
-                print(INDENT + line)
-
-    def _display_short(self, repo, all_, INDENT, color, RED, REDBOLD, GREEN,
-                       GREENBOLD, YELLOW, YELLOWBOLD, BLUE, BLUEBOLD,
-                       PURPLE, PURPLEBOLD, CYAN, CYANBOLD, WHITE, WHITEBOLD,
-                       RESET):
-        workspace = []
-        branches = []
+            header = ''.join((colors['GREENBOLD'], repo.displayname, RESET,
+                              '\n'))
+        else:
+            return ''
+        return ''.join([header] + workspace + branches)
+
+    @staticmethod
+    def _format_branch(branchstr, remote, status, all_, colors, symbols):
+        # Return (line, action_required) for the status of a branch with one
+        #  of its remotes, which is None if it must not be displayed; line is
+        #  None if the status must not be displayed
+        remotestr = '' if remote is None else ' ({})'.format(remote)
+        if status is None:
+            symbol = '{'
+        elif status[0] > 0:
+            if status[1] > 0:
+                symbol = '#'
+                count = '|'.join((str(status[0]), str(status[1])))
+            else:
+                symbol = '>'
+                count = str(status[0])
+        elif status[1] > 0:
+            symbol = '<'
+            count = str(status[1])
+        else:
+            symbol = '='
+        if symbol in ('{', '='):
+            if not all_:
+                return (None, False)
+            return (''.join((symbols[symbol], ' ', branchstr, remotestr)),
+                    False)
+        return (''.join((symbols[symbol], ' ', branchstr, remotestr, ' ',
+                         colors['YELLOW'], count, colors['RESET'])), True)
+
+    def _format_short(self, repo, all_, colors, symbol_colors, symbols):
+        # Return the line of the repository, or '' if it is not displayed
+        RESET = colors['RESET']
+        parts = []
         action_required = False
 
-        if repo.uncommitted:
-            workspace.append(color('{}*'.format(len(repo.uncommitted)), RED))
+        if repo.uncommitted_count:
+            parts.append(''.join((symbol_colors['*'],
+                                  str(repo.uncommitted_count), '*', RESET)))
             action_required = True
-        if repo.untracked:
-            workspace.append(color('{}?'.format(len(repo.untracked)), CYAN))
+        if repo.untracked_count:
+            parts.append(''.join((symbol_colors['?'],
+                                  str(repo.untracked_count), '?', RESET)))
             action_required = True
-
-        if all_:
-            for type_ in ('=', '{'):
-                if repo.branch_stats[type_] > 0:
-                    branches.append(color(''.join((str(repo.branch_stats[type_]
-                                                       ), type_)), GREEN))
-        if repo.branch_stats['<'] > 0:
-            branches.append(color(''.join((str(repo.branch_stats['<']), '<')),
-                            CYAN))
+        if repo.timed_out:
+            parts.append(symbols['!'])
             action_required = True
-        for type_ in ('>', '#', '}'):
-            if repo.branch_stats[type_] > 0:
-                branches.append(color(''.join((str(repo.branch_stats[type_]),
-                                      type_)), RED))
-                action_required = True
 
-        if all_:
-            if action_required:
-                print('{} {}'.format(color(repo.displayname, REDBOLD),
-                                     ' '.join(workspace + branches)))
-            else:
-                print('{} {}'.format(repo.displayname,
-                                     ' '.join(workspace + branches)))
-        elif action_required:
-            print('{} {}'.format(repo.displayname,
-                                 ' '.join(workspace + branches)))
+        # The branch stats of the repositories that timed out may be None
+        branch_stats = repo.branch_stats or {}
+        for symbol, optional in self.SHORT_BRANCH_STATS:
+            count = branch_stats.get(symbol, 0)
+            if count > 0 and (all_ or not optional):
+                parts.append(''.join((symbol_colors[symbol], str(count),
+                                      symbol, RESET)))
+                action_required |= not optional
+
+        if all_ and action_required:
+            return ''.join((colors['REDBOLD'], repo.displayname, RESET, ' ',
+                            ' '.join(parts), '\n'))
+        if all_ or action_required:
+            return ''.join((repo.displayname, ' ', ' '.join(parts), '\n'))
+        return ''
+
+
+class JSONViewer:
+    def __init__(self, repos):
+        # repos is accepted in the same forms as for Viewer
+        self.repos = repos
+
+    @staticmethod
+    def serialize(repo):
+        # Return a dictionary of JSON-compatible values for the repository
+        if repo.branch_to_remotes_to_status is None:
+            branch_to_remotes_to_status = None
+        else:
+            branch_to_remotes_to_status = {
+                branch: {remote: None if status is None else
+                         {'ahead': status[0], 'behind': status[1]}
+                         for remote, status in remotes_to_status.items()}
+                for branch, remotes_to_status in
+                repo.branch_to_remotes_to_status.items()}
+        return {
+            'path': repo.absdirpath,
+            'name': repo.displayname,
+            'vcs': repo.COMMAND,
+            'current_branch': repo.current_branch,
+            'uncommitted': None if repo.uncommitted is None else [
+                {'status': status, 'path': filepath}
+                for status, filepath in repo.uncommitted],
+            'untracked': None if repo.untracked is None else [
+                {'status': status, 'path': filepath}
+                for status, filepath in repo.untracked],
+            'uncommitted_count': repo.uncommitted_count,
+            'untracked_count': repo.untracked_count,
+            'branch_to_remotes_to_status': branch_to_remotes_to_status,
+            'branch_stats': repo.branch_stats,
+            # The fields that could not be computed are None
+            'timed_out': repo.timed_out,
+            'inspect_time': repo.inspect_time,
+        }
+
+    def dump(self, stream, ndjson=False):
+        # Every record is written as soon as its repository is available, so
+        #  that also huge runs can be parsed as a stream
+        if isinstance(self.repos, dict):
+            repos = (self.repos[repopath]
+                     for repopath in sorted(self.repos.keys()))
+        else:
+            repos = self.repos
+
+        if ndjson:
+            for repo in repos:
+                stream.write(json.dumps(self.serialize(repo)))
+                stream.write('\n')
+        else:
+            separator = '[\n'
+            for repo in repos:
+                stream.write(separator)
+                stream.write(json.dumps(self.serialize(repo)))
+                separator = ',\n'
+            stream.write('[]\n' if separator == '[\n' else '\n]\n')
+
+    def display_results(self, ndjson=False):
+        self.dump(sys.stdout, ndjson)
+
+
+class Profiler:
+    def __init__(self):
+        # An instance can be passed in RepoCheck's exec_hooks to collect the
+        #  ExecRecords of a run
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    @staticmethod
+    def get_subcommand(command):
+        # Skip the global options, e.g. 'git -c key=value status'
+        args = iter(command[1:])
+        for arg in args:
+            if arg in ('-c', '-C'):
+                next(args, None)
+            elif not arg.startswith('-'):
+                return ' '.join((command[0], arg))
+        return command[0]
+
+    def print_report(self, timings, stream=sys.stderr, slowest=10):
+        # timings is a {phase: seconds} dictionary like RepoCheck.timings,
+        #  possibly with other phases added by the caller
+        INDENT = ' ' * 4
+        subcommand_to_stats = {}
+        repo_to_stats = {}
+        for record in self.records:
+            for key, key_to_stats in ((self.get_subcommand(record.command),
+                                       subcommand_to_stats),
+                                      (record.repo, repo_to_stats)):
+                try:
+                    stats = key_to_stats[key]
+                except KeyError:
+                    stats = key_to_stats[key] = [0, 0.0, 0]
+                stats[0] += 1
+                stats[1] += record.time
+                stats[2] += record.returncode != 0
+
+        print('Phases:', file=stream)
+        for phase, seconds in timings.items():
+            print('{}{:<12} {:9.3f}s'.format(INDENT, phase, seconds),
+                  file=stream)
+        print('Commands: {} ({} forks), {:.3f}s'.format(
+              len(self.records),
+              sum(record.forked for record in self.records),
+              sum(record.time for record in self.records)), file=stream)
+        for subcommand, (count, seconds, failed) in sorted(
+                subcommand_to_stats.items(), key=lambda item: item[1][1],
+                reverse=True):
+            print('{}{:<24} {:6} {:9.3f}s {:6} failed'.format(
+                  INDENT, subcommand, count, seconds, failed), file=stream)
+        print('Slowest repositories:', file=stream)
+        for repo, (count, seconds, failed) in sorted(
+                repo_to_stats.items(), key=lambda item: item[1][1],
+                reverse=True)[:slowest]:
+            print('{}{:9.3f}s {:4} commands  {}'.format(INDENT, seconds,
+                                                        count, repo),
+                  file=stream)
 
 
 def main():
@@ -399,22 +2336,90 @@ def main():
     cliparser.add_argument('-u', '--update-remotes', action='store_true',
                            help='fetch updates for the remotes before '
                                 'checking a repository')
+    cliparser.add_argument('--fetch-jobs', type=int, default=8, metavar='N',
+                           help='with --update-remotes, run up to N fetches '
+                                'in parallel (default: %(default)s)')
+    cliparser.add_argument('--fetch-host-jobs', type=int, default=2,
+                           metavar='N',
+                           help='with --update-remotes, run up to N fetches '
+                                'in parallel from the same host (default: '
+                                '%(default)s)')
+    cliparser.add_argument('--fetch-if-older-than', type=_parse_duration,
+                           metavar='DURATION',
+                           help='with --update-remotes, only fetch the '
+                                'remotes that were last fetched longer than '
+                                'DURATION ago, e.g. 30s, 10m, 2h or 1d, and '
+                                'retry the remotes that keep failing less '
+                                'and less often')
     cliparser.add_argument('-a', '--all', action='store_true',
                            help='show all repositories and branches even when '
                                 'they require no action')
     cliparser.add_argument('-e', '--expanded', action='store_true',
                            help='print detailed information for every '
                                 'repository')
+    cliparser.add_argument('-f', '--format', default='text',
+                           choices=('text', 'json', 'ndjson'),
+                           help='print the results as colored text, as a JSON '
+                                'array or as one JSON object per line '
+                                '(default: %(default)s)')
     cliparser.add_argument('-p', '--rel-paths', action='store_true',
                            help='print the relative paths to the repositories '
                                 'instead of just their names')
     cliparser.add_argument('-l', '--follow-links', action='store_true',
-                           help='follow links to directories (*warning:* this '
-                                'can lead to infinite recursion if a link '
-                                'points to an ancestor directory of itself)')
+                           help='follow links to directories (directories '
+                                'that were already visited are skipped)')
     cliparser.add_argument('-n', '--no-nested-repos', action='store_true',
                            help='do not look for repositories in repository '
                                 'subdirectories')
+    cliparser.add_argument('-x', '--exclude', action='append', default=[],
+                           metavar='PATTERN',
+                           help='do not look for repositories in the '
+                                'directories whose name or path relative to '
+                                'the root directory matches the PATTERN glob; '
+                                'can be given multiple times')
+    cliparser.add_argument('-d', '--max-depth', type=int, metavar='N',
+                           help='do not look for repositories more than N '
+                                'levels below the root directories')
+    cliparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                           help='inspect up to N repositories in parallel '
+                                '(default: %(default)s)')
+    cliparser.add_argument('--no-cache', action='store_true',
+                           help='do not read or update the index of the '
+                                'repository directories and the cache of the '
+                                'branch status of the repositories')
+    cliparser.add_argument('--rescan', action='store_true',
+                           help='search all the root directories again '
+                                'instead of only the directories that changed '
+                                'since the last run')
+    cliparser.add_argument('-s', '--stream', action='store_true',
+                           help='print every repository as soon as it is '
+                                'checked, in discovery order, instead of '
+                                'sorting the output at the end')
+    cliparser.add_argument('--no-untracked', action='store_true',
+                           help='do not look for untracked files, which can '
+                                'be slow in huge worktrees')
+    cliparser.add_argument('--untracked-cache', action='store_true',
+                           help="use git's untracked cache to speed up the "
+                                'search for untracked files')
+    cliparser.add_argument('--fsmonitor', action='store_true',
+                           help="use git's file system monitor daemon to "
+                                'speed up the workspace status (requires git '
+                                '2.36 or later)')
+    cliparser.add_argument('--timeout', type=float, metavar='SECONDS',
+                           help='stop checking a repository after SECONDS, '
+                                'counted from its first command, and mark it '
+                                'as unknown; every fetch has a separate '
+                                'deadline, counted from its start, and only '
+                                'fails the remote that timed out')
+    cliparser.add_argument('--command-timeout', type=float,
+                           metavar='SECONDS',
+                           help='kill every single command that runs for '
+                                'more than SECONDS, and mark its repository '
+                                'as unknown')
+    cliparser.add_argument('--profile', action='store_true',
+                           help='print to standard error a summary of where '
+                                'time was spent: phases, commands and slowest '
+                                'repositories')
     cliparser.add_argument('-L', '--legend', action='store_true',
                            help='display a legend for the used symbols and '
                                 'exit')
@@ -429,11 +2434,37 @@ def main():
     if cliargs.legend:
         Viewer.print_legend(cliargs.no_colors)
         sys.exit()
+    profiler = Profiler() if cliargs.profile else None
     repocheck = RepoCheck(cliargs.update_remotes, cliargs.rootdirs,
                           cliargs.follow_links, not cliargs.no_nested_repos,
-                          cliargs.rel_paths)
-    Viewer(repocheck.repos).display_results(cliargs.expanded, cliargs.all,
-                                            cliargs.no_colors)
+                          cliargs.rel_paths, cliargs.jobs,
+                          cliargs.fetch_jobs, cliargs.fetch_host_jobs,
+                          not cliargs.no_cache, cliargs.exclude,
+                          cliargs.max_depth, cliargs.rescan, cliargs.stream,
+                          not cliargs.no_untracked, cliargs.untracked_cache,
+                          cliargs.fsmonitor, cliargs.timeout,
+                          cliargs.command_timeout,
+                          cliargs.fetch_if_older_than,
+                          # The short text view only needs the numbers of
+                          #  uncommitted and untracked files
+                          counts_only=cliargs.format == 'text' and
+                          not cliargs.expanded,
+                          exec_hooks=(profiler, ) if profiler else ())
+    repos = repocheck.iter_repos() if cliargs.stream else repocheck.repos
+    start = time.perf_counter()
+    if cliargs.format == 'text':
+        Viewer(repos).display_results(cliargs.expanded, cliargs.all,
+                                      cliargs.no_colors)
+    else:
+        JSONViewer(repos).display_results(cliargs.format == 'ndjson')
+    if profiler:
+        # When streaming, the time spent inside iter_repos is already
+        #  accounted to the other phases
+        timings = dict(repocheck.timings)
+        timings['rendering'] = time.perf_counter() - start - (
+            timings['inspection'] + timings['discovery'] + timings['fetch']
+            if cliargs.stream else 0)
+        profiler.print_report(timings)
 
 
 if __name__ == '__main__':
@@ -39,8 +39,10 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Software Development :: Version Control',
         'Topic :: Software Development :: Version Control :: Git',
+        'Topic :: Software Development :: Version Control :: Mercurial',
+        'Topic :: Software Development :: Version Control :: SVN',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',  # noqa
         'Programming Language :: Python :: 3',
     ],
-    keywords='git repository',
+    keywords='git mercurial subversion repository',
 )
@@ -0,0 +1,244 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+from repocheck import RepoCheck, _RemoteUpdater
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='repocheck',
+               GIT_AUTHOR_EMAIL='repocheck@localhost',
+               GIT_COMMITTER_NAME='repocheck',
+               GIT_COMMITTER_EMAIL='repocheck@localhost',
+               GIT_CONFIG_NOSYSTEM='1')
+
+# A 'git' wrapper whose fetches only log their start and end times and
+#  directory, and succeed, so that any URL can be used
+LOGGING_GIT = '''\
+import os
+import sys
+import time
+if 'fetch' in sys.argv:
+    with open(os.environ['FETCH_LOG'], 'a') as stream:
+        stream.write('start {{}} {{}}\\n'.format(time.time(), os.getcwd()))
+    time.sleep(0.2)
+    with open(os.environ['FETCH_LOG'], 'a') as stream:
+        stream.write('end {{}} {{}}\\n'.format(time.time(), os.getcwd()))
+    sys.exit(0)
+os.execv({!r}, ['git'] + sys.argv[1:])
+'''.format(shutil.which('git'))
+
+
+class FetchTestCase(unittest.TestCase):
+    # The remotes are bare repositories in the same temporary directory
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.rootdir = os.path.join(self.tmpdir, 'tree')
+        os.makedirs(self.rootdir)
+        patcher = mock.patch.dict(os.environ, XDG_CACHE_HOME=os.path.join(
+                                                        self.tmpdir, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def git(self, cwd, *args):
+        return subprocess.run(('git', ) + args, cwd=cwd, env=GIT_ENV,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              check=True).stdout.decode().strip()
+
+    def make_remote(self, name):
+        remotedir = os.path.join(self.tmpdir, 'remotes', name + '.git')
+        os.makedirs(remotedir)
+        self.git(remotedir, 'init', '-q', '--bare')
+        return remotedir
+
+    def make_repo(self, name, remotes=()):
+        # Every remote gets the repository's commit
+        repodir = os.path.join(self.rootdir, name)
+        self.git(self.rootdir, 'init', '-q', '-b', 'master', repodir)
+        self.git(repodir, 'commit', '-q', '--allow-empty', '-m', name)
+        for remote in remotes:
+            self.git(repodir, 'remote', 'add', remote,
+                     self.make_remote('{}-{}'.format(name, remote)))
+            self.git(repodir, 'push', '-q', remote, 'master')
+        return repodir
+
+    def run_repocheck(self, **kwargs):
+        with redirect_stderr(io.StringIO()) as stderr:
+            check = RepoCheck(update_remotes=True, rootdirs=(self.rootdir, ),
+                              **kwargs)
+        return (check, stderr.getvalue())
+
+
+class TestFetchIfOlderThan(FetchTestCase):
+    def make_fetched_repo(self, age, state=False):
+        # With state, the remotes are fetched by repocheck, so that they
+        #  have a fetch state too
+        repodir = self.make_repo('repo', ('origin', 'up'))
+        mtime = time.time() - age
+        if state:
+            with mock.patch('time.time', return_value=mtime):
+                self.run_repocheck(fetch_if_older_than=3600)
+        else:
+            self.git(repodir, 'fetch', '-q', '--all')
+        os.utime(os.path.join(repodir, '.git', 'FETCH_HEAD'), (mtime, mtime))
+        self.git(repodir, 'remote', 'add', 'new', self.make_remote('new'))
+        return repodir
+
+    def test_new_remote_of_stale_repository(self):
+        repodir = self.make_fetched_repo(7200)
+        check, _ = self.run_repocheck(fetch_if_older_than=3600)
+        self.assertEqual(sorted(check.fetch_results[repodir]),
+                         ['new', 'origin', 'up'])
+
+    def test_new_remote_after_stale_fetch_states(self):
+        # The fetches of the stale remotes rewrite FETCH_HEAD, which must
+        #  not make the new remote look fresh
+        repodir = self.make_fetched_repo(7200, state=True)
+        check, _ = self.run_repocheck(fetch_if_older_than=3600)
+        self.assertEqual(sorted(check.fetch_results[repodir]),
+                         ['new', 'origin', 'up'])
+
+    def test_new_remote_of_fresh_repository(self):
+        repodir = self.make_fetched_repo(60)
+        check, stderr = self.run_repocheck(fetch_if_older_than=3600)
+        self.assertEqual(sorted(check.fetch_results[repodir]), ['new'])
+        self.assertIn('Skipped 2 remotes', stderr)
+        # The remotes skipped through FETCH_HEAD now have a fetch state too
+        check, stderr = self.run_repocheck(fetch_if_older_than=3600)
+        self.assertEqual(check.fetch_results[repodir], {})
+        self.assertIn('Skipped 3 remotes', stderr)
+
+
+class TestRemoteSelection(FetchTestCase):
+    def test_skip_default_update(self):
+        repodir = self.make_repo('repo', ('a', 'b', 'c'))
+        self.git(repodir, 'config', 'remote.b.skipDefaultUpdate', 'true')
+        check, _ = self.run_repocheck()
+        self.assertEqual(sorted(check.fetch_results[repodir]), ['a', 'c'])
+        self.assertEqual(check.fetch_results[repodir]['a'][0], 0)
+
+    def test_remotes_default(self):
+        # The default group overrides skipDefaultUpdate
+        repodir = self.make_repo('repo', ('a', 'b', 'c'))
+        self.git(repodir, 'config', 'remote.b.skipDefaultUpdate', 'true')
+        self.git(repodir, 'config', 'remotes.default', 'b c')
+        check, _ = self.run_repocheck()
+        self.assertEqual(sorted(check.fetch_results[repodir]), ['b', 'c'])
+
+    def test_failing_remote(self):
+        repodir = self.make_repo('repo', ('good', ))
+        self.git(repodir, 'remote', 'add', 'bad',
+                 os.path.join(self.tmpdir, 'missing.git'))
+        check, stderr = self.run_repocheck()
+        results = check.fetch_results[repodir]
+        self.assertEqual(results['good'][0], 0)
+        self.assertNotEqual(results['bad'][0], 0)
+        self.assertIn('Could not update repo remotes: bad', stderr)
+
+
+class TestFetchOrder(FetchTestCase):
+    # The fetches go through LOGGING_GIT, and are checked through its log
+
+    def setUp(self):
+        super().setUp()
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.makedirs(bindir)
+        path = os.path.join(bindir, 'git')
+        with open(path, 'w') as stream:
+            stream.write('#!{}\n'.format(sys.executable))
+            stream.write(LOGGING_GIT)
+        os.chmod(path, 0o755)
+        self.log = os.path.join(self.tmpdir, 'fetch.log')
+        patcher = mock.patch.dict(os.environ, FETCH_LOG=self.log, PATH=(
+                            os.pathsep.join((bindir, os.environ['PATH']))))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_url_repo(self, name, url):
+        repodir = os.path.join(self.rootdir, name)
+        self.git(self.rootdir, 'init', '-q', repodir)
+        self.git(repodir, 'remote', 'add', 'origin', url)
+        return repodir
+
+    def read_log(self):
+        # Return [(event, time, repodir)] in time order
+        with open(self.log) as stream:
+            events = [line.split(' ', 2)
+                      for line in stream.read().splitlines()]
+        return sorted(((event, float(time_), repodir)
+                       for event, time_, repodir in events),
+                      key=lambda event: event[1])
+
+    def get_max_concurrency(self):
+        running = maximum = 0
+        for event, _, _ in self.read_log():
+            running += 1 if event == 'start' else -1
+            maximum = max(maximum, running)
+        return maximum
+
+    def test_host_slots(self):
+        for index in range(6):
+            self.make_url_repo('repo{}'.format(index),
+                               'https://example.com/repo{}.git'.format(index))
+        check, _ = self.run_repocheck(fetch_jobs=8, fetch_host_jobs=2)
+        self.assertEqual(len(check.fetch_results), 6)
+        self.assertEqual(self.get_max_concurrency(), 2)
+
+    def test_global_slots(self):
+        for index in range(6):
+            self.make_url_repo('repo{}'.format(index),
+                               'https://host{}.example.com/repo.git'.format(
+                                                                    index))
+        check, _ = self.run_repocheck(fetch_jobs=3, fetch_host_jobs=2)
+        self.assertEqual(len(check.fetch_results), 6)
+        self.assertEqual(self.get_max_concurrency(), 3)
+
+    def borrow(self, repodir, lenderdir):
+        with open(os.path.join(repodir, '.git', 'objects', 'info',
+                               'alternates'), 'a') as stream:
+            stream.write(os.path.join(lenderdir, '.git', 'objects') + '\n')
+
+    def test_alternates_order(self):
+        # The borrower is found first, but only fetched once the
+        #  repository it borrows from has been fetched
+        borrower = self.make_url_repo('a-borrower',
+                                      'https://one.example.com/repo.git')
+        lender = self.make_url_repo('b-lender',
+                                    'https://two.example.com/repo.git')
+        self.borrow(borrower, lender)
+        self.run_repocheck()
+        times = {(event, os.path.realpath(repodir)): time_
+                 for event, time_, repodir in self.read_log()}
+        self.assertLessEqual(times[('end', os.path.realpath(lender))],
+                             times[('start', os.path.realpath(borrower))])
+
+    def test_alternates_cycle(self):
+        # Repositories that borrow from each other are still fetched
+        one = self.make_url_repo('one', 'https://one.example.com/repo.git')
+        two = self.make_url_repo('two', 'https://two.example.com/repo.git')
+        self.borrow(one, two)
+        self.borrow(two, one)
+        check, _ = self.run_repocheck()
+        self.assertEqual(sorted(check.fetch_results), [one, two])
+
+
+class TestBreakCycles(unittest.TestCase):
+    def test_break_cycles(self):
+        dependencies = {'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['a'],
+                        'e': ['e']}
+        _RemoteUpdater.break_cycles(dependencies)
+        # Only the first dependency of the cycle is dropped
+        self.assertEqual(dependencies, {'a': [], 'b': ['c'], 'c': ['a'],
+                                        'd': ['a'], 'e': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+
+from repocheck import Viewer, _Git
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='repocheck',
+               GIT_AUTHOR_EMAIL='repocheck@localhost',
+               GIT_COMMITTER_NAME='repocheck',
+               GIT_COMMITTER_EMAIL='repocheck@localhost',
+               GIT_CONFIG_NOSYSTEM='1')
+
+
+class TestGitStatus(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.repodir = os.path.join(tmpdir.name, 'repo')
+        os.makedirs(self.repodir)
+        self.git('init', '-q', '-b', 'master')
+        self.write('renamed', 'renamed\n')
+        self.write('conflict', 'base\n')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'base')
+
+    def git(self, *args, check=True):
+        subprocess.run(('git', ) + args, cwd=self.repodir, env=GIT_ENV,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=check)
+
+    def write(self, name, content):
+        with open(os.path.join(os.fsencode(self.repodir), os.fsencode(name)),
+                  'w') as stream:
+            stream.write(content)
+
+    def get_pending_changes(self):
+        return _Git(self.repodir, False).get_pending_changes()
+
+    def test_rename(self):
+        self.git('mv', 'renamed', 'new name')
+        uncommitted = self.get_pending_changes()[0]
+        self.assertEqual(uncommitted, [('R ', 'renamed -> new name')])
+
+    def test_unmerged(self):
+        self.git('checkout', '-q', '-b', 'other')
+        self.write('conflict', 'other\n')
+        self.git('commit', '-q', '-am', 'other')
+        self.git('checkout', '-q', 'master')
+        self.write('conflict', 'master\n')
+        self.git('commit', '-q', '-am', 'master')
+        self.git('merge', '-q', 'other', check=False)
+        uncommitted, _, count, _, branch = self.get_pending_changes()
+        self.assertEqual(uncommitted, [('UU', 'conflict')])
+        self.assertEqual((count, branch), (1, 'master'))
+
+    def test_special_names(self):
+        # The paths are kept as they are, undecodable bytes included
+        self.write('new\nline', '')
+        self.write(os.fsdecode(b'bad\xffname'), '')
+        self.write('esc\033[31m', '')
+        self.git('mv', 'renamed', 'tab\tname')
+        uncommitted, untracked, _, count, _ = self.get_pending_changes()
+        self.assertEqual(uncommitted, [('R ', 'renamed -> tab\tname')])
+        self.assertEqual(sorted(untracked),
+                         [('??', os.fsdecode(b'bad\xffname')),
+                          ('??', 'esc\033[31m'), ('??', 'new\nline')])
+        self.assertEqual(count, 3)
+
+    def test_quoted_view(self):
+        self.write('new\nline', '')
+        self.write(os.fsdecode(b'bad\xffname'), '')
+        self.write('plain è', '')
+        self.git('mv', 'renamed', 'tab\tname')
+        repo = _Git(self.repodir, False)
+        stream = io.StringIO()
+        Viewer([repo]).dump(stream, True, True, True)
+        lines = stream.getvalue().encode('utf-8').decode().splitlines()
+        self.assertIn('        R  renamed -> "tab\\tname"', lines)
+        self.assertIn('        ?? "new\\nline"', lines)
+        self.assertIn('        ?? "bad\\377name"', lines)
+        self.assertIn('        ?? plain è', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+REPOCHECK = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'repocheck.py')
+
+# Stub 'hg' executables: one that always fails, and one whose command server
+#  announces itself and then dies before answering the first command
+FAILING_HG = '''\
+import sys
+sys.stderr.write('abort: broken\\n')
+sys.exit(255)
+'''
+
+DYING_SERVER_HG = '''\
+import struct
+import sys
+if 'serve' in sys.argv:
+    hello = b'capabilities: getencoding runcommand\\nencoding: UTF-8'
+    sys.stdout.buffer.write(struct.pack('>cI', b'o', len(hello)) + hello)
+    sys.stdout.buffer.flush()
+    sys.stdin.buffer.read(1)
+sys.exit(255)
+'''
+
+
+class TestFailingMercurial(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.bindir = os.path.join(self.tmpdir.name, 'bin')
+        self.rootdir = os.path.join(self.tmpdir.name, 'tree')
+        os.makedirs(self.bindir)
+        os.makedirs(os.path.join(self.rootdir, 'hgrepo', '.hg'))
+        env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@a',
+                   GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@a')
+        gitdir = os.path.join(self.rootdir, 'gitrepo')
+        subprocess.run(['git', 'init', '-q', gitdir], check=True)
+        subprocess.run(['git', 'commit', '-q', '--allow-empty', '-m', 'x'],
+                       cwd=gitdir, env=env, check=True)
+        # An untracked file makes the git repository show up in the output
+        open(os.path.join(gitdir, 'new'), 'w').close()
+
+    def run_repocheck(self, stub):
+        path = os.path.join(self.bindir, 'hg')
+        with open(path, 'w') as stream:
+            stream.write('#!{}\n'.format(sys.executable))
+            stream.write(textwrap.dedent(stub))
+        os.chmod(path, 0o755)
+        env = dict(os.environ,
+                   PATH=os.pathsep.join((self.bindir, os.environ['PATH'])),
+                   XDG_CACHE_HOME=os.path.join(self.tmpdir.name, 'cache'))
+        return subprocess.run([sys.executable, REPOCHECK, '--no-colors',
+                               '--all', self.rootdir],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=env, timeout=60, universal_newlines=True)
+
+    def assert_run_completes(self, process):
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertNotIn('Traceback', process.stderr)
+        names = [line.split()[0] for line in process.stdout.splitlines()
+                 if line.strip()]
+        self.assertIn('gitrepo', names)
+        self.assertIn('hgrepo', names)
+
+    def test_server_fails_to_start(self):
+        self.assert_run_completes(self.run_repocheck(FAILING_HG))
+
+    def test_server_dies(self):
+        self.assert_run_completes(self.run_repocheck(DYING_SERVER_HG))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import io
+import unittest
+
+from repocheck import ExecRecord, Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_forks(self):
+        # The commands run by a Mercurial command server are not forks
+        profiler = Profiler()
+        profiler(ExecRecord(('hg', 'serve', '--cmdserver', 'pipe'), '/repo',
+                            0.5, 0, 0, True))
+        for subcommand in ('status', 'incoming', 'outgoing'):
+            profiler(ExecRecord(('hg', subcommand), '/repo', 0.25, 0, 10,
+                                False))
+        profiler(ExecRecord(('git', 'status'), '/other', 0.25, 1, 0, True))
+        stream = io.StringIO()
+        profiler.print_report({'inspection': 1.5}, stream)
+        lines = stream.getvalue().splitlines()
+        self.assertIn('Commands: 5 (2 forks), 1.500s', lines)
+        self.assertIn('    git status                    1     0.250s      '
+                      '1 failed', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+REPOCHECK = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'repocheck.py')
+
+# A stub 'svn' executable for working copies on trunk, each with one
+#  modified file, and one more modified file in a changelist
+STUB_SVN = '''\
+import sys
+from xml.sax.saxutils import quoteattr
+paths = [arg for arg in sys.argv[2:] if not arg.startswith('-')]
+out = ['<?xml version="1.0" encoding="UTF-8"?>']
+if sys.argv[1] == 'info':
+    out.append('<info>')
+    for path in paths:
+        out.append('<entry kind="dir" path={} revision="1">'
+                   '<relative-url>^/trunk</relative-url>'
+                   '</entry>'.format(quoteattr(path)))
+    out.append('</info>')
+else:
+    out.append('<status>')
+    for path in paths:
+        entry = ('<entry path={}><wc-status item="modified" props="none"'
+                 ' revision="1"/></entry>')
+        out.append('<target path={}>'.format(quoteattr(path)))
+        out.append(entry.format(quoteattr(path + '/plain.c')))
+        out.append('<changelist name="feature">')
+        out.append(entry.format(quoteattr(path + '/listed.c')))
+        out.append('</changelist>')
+        out.append('</target>')
+    out.append('</status>')
+print('\\n'.join(out))
+'''
+
+
+class TestSubversionStatus(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.bindir = os.path.join(self.tmpdir.name, 'bin')
+        self.rootdir = os.path.join(self.tmpdir.name, 'tree')
+        os.makedirs(self.bindir)
+        for name in ('wc1', 'wc2'):
+            os.makedirs(os.path.join(self.rootdir, name, '.svn'))
+        path = os.path.join(self.bindir, 'svn')
+        with open(path, 'w') as stream:
+            stream.write('#!{}\n'.format(sys.executable))
+            stream.write(textwrap.dedent(STUB_SVN))
+        os.chmod(path, 0o755)
+
+    def run_repocheck(self, *args):
+        env = dict(os.environ,
+                   PATH=os.pathsep.join((self.bindir, os.environ['PATH'])),
+                   XDG_CACHE_HOME=os.path.join(self.tmpdir.name, 'cache'))
+        return subprocess.run([sys.executable, REPOCHECK] + list(args) +
+                              [self.rootdir],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=env, timeout=60, universal_newlines=True)
+
+    def test_changelist_entries(self):
+        process = self.run_repocheck('-f', 'json')
+        self.assertEqual(process.returncode, 0, process.stderr)
+        repos = json.loads(process.stdout)
+        self.assertEqual(sorted(repo['name'] for repo in repos),
+                         ['wc1', 'wc2'])
+        for repo in repos:
+            self.assertEqual(repo['current_branch'], 'trunk')
+            self.assertEqual(repo['uncommitted_count'], 2)
+            self.assertEqual(sorted(change['path']
+                                    for change in repo['uncommitted']),
+                             ['listed.c', 'plain.c'])
+
+
+if __name__ == '__main__':
+    unittest.main()